@@ -6,20 +6,36 @@ import yt_dlp
 import random
 import string
 import json
+import html
 from datetime import datetime, timedelta
 import pytz
 import httpx
 import py_compile
+import importlib.util
+import hashlib
+import sqlite3
+import time
+import multiprocessing
+import signal
+import heapq
+from collections import Counter, OrderedDict, deque
+from types import MappingProxyType
+from pathlib import Path
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor
 
-from flask import Flask, render_template_string, request, session, redirect, url_for
-from threading import Thread
+from quart import Quart, render_template_string, make_response, request, session, redirect, url_for
+from threading import Lock
 
 from telegram import Update, Bot, User, InlineKeyboardButton, InlineKeyboardMarkup, Document
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.error import BadRequest, InvalidToken, RetryAfter
+from telegram.ext import Application, ApplicationHandlerStop, BaseUpdateProcessor, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, TypeHandler, filters
 
-# --- FLASK, CONFIG, & STATE MANAGEMENT ---
-app = Flask(__name__)
+# --- WEB SERVER, CONFIG, & STATE MANAGEMENT ---
+# The dashboard and webhook endpoint are served by Quart on the bots' own event loop, so a request
+# sees the in-memory state between two bot steps and never races the tracker fan-out.
+app = Quart(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'default-secret-key-for-local-dev')
 ADMIN_USER = os.environ.get('ADMIN_USER', 'admin')
 ADMIN_PASS = os.environ.get('ADMIN_PASS', 'password')
@@ -33,16 +49,80 @@ RENDER_DEPLOY_HOOK_URL = os.environ.get('RENDER_DEPLOY_HOOK_URL')
 
 API_STOCK_URL = "https://gagstock.gleeze.com/grow-a-garden"
 API_WEATHER_URL = "https://growagardenstock.com/api/stock/weather"
-TRACKING_INTERVAL_SECONDS = 45
+# The feed polls hard for RESTOCK_WINDOW_SECONDS after each scheduled restock and backs off to
+# at most IDLE_POLL_SECONDS in between (weather still changes off-schedule).
+RESTOCK_POLL_SECONDS = float(os.environ.get('RESTOCK_POLL_SECONDS', 4))
+RESTOCK_WINDOW_SECONDS = float(os.environ.get('RESTOCK_WINDOW_SECONDS', 90))
+RESTOCK_GRACE_SECONDS = float(os.environ.get('RESTOCK_GRACE_SECONDS', 2))
+IDLE_POLL_SECONDS = float(os.environ.get('IDLE_POLL_SECONDS', 120))
+# Restocks where recorded history gives a prized item at least PRIZED_ODDS_THRESHOLD chance are polled faster.
+PRIZED_POLL_SECONDS = float(os.environ.get('PRIZED_POLL_SECONDS', 2))
+PRIZED_ODDS_THRESHOLD = float(os.environ.get('PRIZED_ODDS_THRESHOLD', 0.05))
+# Outbound sends per bot token, kept under Telegram's ~30 msg/s global and ~1 msg/s per chat limits.
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 25))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3))
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 16))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))
+SEND_CHAT_BUCKETS_MAX = int(os.environ.get('SEND_CHAT_BUCKETS_MAX', 10000))
+# Inbound updates per bot: UPDATE_WORKERS handlers run at once, one at a time per chat; admin panel
+# callbacks get UPDATE_PRIORITY_WORKERS slots of their own. UPDATE_MAX_PENDING caps updates in flight.
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 32))
+UPDATE_PRIORITY_WORKERS = int(os.environ.get('UPDATE_PRIORITY_WORKERS', 4))
+UPDATE_MAX_PENDING = int(os.environ.get('UPDATE_MAX_PENDING', 1024))
+# Each non-admin user may send FLOOD_BURST updates at once, refilled at FLOOD_RATE per second; the rest are dropped.
+FLOOD_RATE = float(os.environ.get('FLOOD_RATE', 1))
+FLOOD_BURST = int(os.environ.get('FLOOD_BURST', 8))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', 10.0))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', 5.0))
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 20))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 10))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY_SECONDS', 120.0))
 MULTOMUSIC_URL = "https://www.youtube.com/watch?v=sPma_hV4_sU"
 WELCOME_VIDEO_URL = "https://youtu.be/VaSazPeDOTM"
 DATA_DIR = "data"
+PERSIST_FLUSH_SECONDS = float(os.environ.get('PERSIST_FLUSH_SECONDS', 2.0))
+MEDIA_DIR = "media"
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', 2))
+# Profiles of at most USER_CACHE_SIZE recently active users are kept in memory. Avatars older than
+# PROFILE_TTL_SECONDS are refreshed in the background, PROFILE_REFRESH_BATCH users every
+# PROFILE_REFRESH_SECONDS, at no more than PROFILE_REFRESH_RATE lookups per second.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 5000))
+PROFILE_TTL_SECONDS = int(os.environ.get('PROFILE_TTL_SECONDS', 3600))
+PROFILE_REFRESH_SECONDS = float(os.environ.get('PROFILE_REFRESH_SECONDS', 5))
+PROFILE_REFRESH_BATCH = int(os.environ.get('PROFILE_REFRESH_BATCH', 20))
+PROFILE_REFRESH_RATE = float(os.environ.get('PROFILE_REFRESH_RATE', 5))
+# Stock history keeps every snapshot for HISTORY_FULL_RES_DAYS, then one per HISTORY_DOWNSAMPLE_SECONDS;
+# snapshots and events older than HISTORY_RETENTION_DAYS are dropped.
+HISTORY_FULL_RES_DAYS = float(os.environ.get('HISTORY_FULL_RES_DAYS', 7))
+HISTORY_DOWNSAMPLE_SECONDS = int(os.environ.get('HISTORY_DOWNSAMPLE_SECONDS', 3600))
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', 180))
+# Restock odds join restock events to the snapshot taken at the same moment, so the window may not reach into downsampled history.
+ODDS_WINDOW_DAYS = min(float(os.environ.get('ODDS_WINDOW_DAYS', 7)), HISTORY_FULL_RES_DAYS)
+# A crashed bot is restarted after BOT_RESTART_BASE_SECONDS, doubling per consecutive failure up to
+# BOT_RESTART_MAX_SECONDS; running for BOT_STABLE_SECONDS clears the failure count.
+BOT_RESTART_BASE_SECONDS = float(os.environ.get('BOT_RESTART_BASE_SECONDS', 5))
+BOT_RESTART_MAX_SECONDS = float(os.environ.get('BOT_RESTART_MAX_SECONDS', 600))
+BOT_STABLE_SECONDS = float(os.environ.get('BOT_STABLE_SECONDS', 300))
+BOT_HEALTH_CHECK_SECONDS = float(os.environ.get('BOT_HEALTH_CHECK_SECONDS', 300))
+# With BOT_SHARDS > 1, child bots are spread over that many processes; shard 0 is this process and
+# also runs the main bot and the dashboard. Processes re-read shared state every SHARD_REFRESH_SECONDS.
+# Only shard 0 polls upstream; the others pick up the snapshot it stores every SHARD_FEED_POLL_SECONDS.
+BOT_SHARDS = max(1, int(os.environ.get('BOT_SHARDS', 1)))
+BOT_SHARD_INDEX = int(os.environ.get('BOT_SHARD_INDEX', 0))
+SHARD_REFRESH_SECONDS = float(os.environ.get('SHARD_REFRESH_SECONDS', 30))
+SHARD_FEED_POLL_SECONDS = float(os.environ.get('SHARD_FEED_POLL_SECONDS', 1))
+# With a public base URL (set explicitly or provided by Render), every bot in shard 0 receives updates
+# through a webhook on the dashboard's PORT instead of long polling. USE_WEBHOOKS=0 forces polling.
+WEBHOOK_BASE_URL = os.environ.get('WEBHOOK_BASE_URL', os.environ.get('RENDER_EXTERNAL_URL', ''))
+USE_WEBHOOKS = bool(WEBHOOK_BASE_URL) and os.environ.get('USE_WEBHOOKS', '1') == '1'
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.blake2b(f"webhook:{os.environ.get('TOKEN', '')}".encode(), digest_size=24).hexdigest()
 
 # --- GLOBAL STATE ---
 ACTIVE_TRACKERS, LAST_SENT_DATA, USER_ACTIVITY = {}, {}, []
 AUTHORIZED_USERS, ADMIN_USERS, BANNED_USERS, RESTRICTED_USERS, PRIZED_ITEMS = set(), set(), set(), set(), set()
-LAST_KNOWN_VERSION, USER_INFO_CACHE, VIP_USERS, VIP_REQUESTS, CUSTOM_COMMANDS = "", {}, {}, {}, {}
-CHILD_BOTS, BOT_REGISTRATION_REQUESTS, SENT_MESSAGES = {}, {}, {}
+LAST_KNOWN_VERSION, VIP_REQUESTS, CUSTOM_COMMANDS = "", {}, {}
+CHILD_BOTS, BOT_REGISTRATION_REQUESTS, SENT_MESSAGES, MEDIA_CACHE = {}, {}, {}, {}
 BOT_START_TIME = datetime.now(pytz.utc)
 PHT = pytz.timezone('Asia/Manila')
 
@@ -62,10 +142,6 @@ def load_json_from_file(filename, default_type=dict):
         with open(filepath, 'r') as f: return json.load(f)
     except (json.JSONDecodeError, ValueError): return default_type()
 
-def save_json_to_file(filename, data):
-    filepath = get_data_filepath(filename)
-    with open(filepath, 'w') as f: json.dump(data, f, indent=4)
-
 def load_set_from_file(filename):
     filepath = get_data_filepath(filename)
     if not os.path.exists(filepath): return set()
@@ -76,55 +152,340 @@ def load_int_set_from_file(filename):
     if not os.path.exists(filepath): return set()
     with open(filepath, 'r') as f: return {int(line.strip()) for line in f if line.strip().isdigit()}
 
-def save_to_file(filename, data_set):
-    filepath = get_data_filepath(filename)
-    with open(filepath, 'w') as f:
-        for item in data_set: f.write(f"{item}\n")
-
-def load_all_data():
-    global AUTHORIZED_USERS, ADMIN_USERS, BANNED_USERS, RESTRICTED_USERS, PRIZED_ITEMS, LAST_KNOWN_VERSION, VIP_USERS, CUSTOM_COMMANDS, VIP_REQUESTS, USER_INFO_CACHE, CHILD_BOTS, BOT_REGISTRATION_REQUESTS
-    AUTHORIZED_USERS = load_int_set_from_file("authorized_users.txt"); ADMIN_USERS = load_int_set_from_file("admins.txt")
-    BANNED_USERS = load_int_set_from_file("banned_users.txt"); RESTRICTED_USERS = load_int_set_from_file("restricted_users.txt")
-    PRIZED_ITEMS = load_set_from_file("prized_items.txt") or {"master sprinkler", "beanstalk", "advanced sprinkler", "godly sprinkler", "ember lily"}
+# --- STATE STORE ---
+# All durable state lives in an SQLite database (WAL mode) with one row per user, role, VIP, bot, etc.,
+# so a change writes a single row instead of rewriting a whole file. The in-memory globals stay the
+# hot copy; save_row()/delete_row() only mark rows dirty and a background task flushes them in one
+# transaction every PERSIST_FLUSH_SECONDS, off the event loop.
+STATE_DB_FILE = "state.db"
+STATE_TABLES = {
+    'users': (('user_id',), ('first_name', 'username', 'avatar_path', 'timestamp', 'command_count', 'approved_date')),
+    'user_roles': (('user_id', 'role'), ()),
+    'vips': (('user_id',), ('expires_at',)),
+    'vip_requests': (('ticket_code',), ('user_id',)),
+    'child_bots': (('token',), ('name', 'owner_id', 'username', 'approved_by', 'created_at')),
+    'bot_registrations': (('request_code',), ('user_id', 'user_first_name', 'bot_name', 'bot_token', 'bot_username')),
+    'custom_commands': (('name',), ('response', 'permission')),
+    'prized_items': (('name',), ()),
+    'media_cache': (('asset',), ('path', 'file_ids')),
+    'settings': (('key',), ('value',)),
+    'trackers': (('chat_id',), ('bot_token', 'filters', 'is_muted', 'first_name', 'version', 'last_hash')),
+}
+JSON_COLUMNS = {'file_ids', 'value', 'filters'}
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, username TEXT, avatar_path TEXT, timestamp TEXT, command_count INTEGER DEFAULT 0, approved_date TEXT);
+CREATE TABLE IF NOT EXISTS user_roles (user_id INTEGER NOT NULL, role TEXT NOT NULL, PRIMARY KEY (user_id, role)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_user_roles_role ON user_roles (role);
+CREATE TABLE IF NOT EXISTS vips (user_id INTEGER PRIMARY KEY, expires_at TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_vips_expires_at ON vips (expires_at);
+CREATE TABLE IF NOT EXISTS vip_requests (ticket_code TEXT PRIMARY KEY, user_id INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_vip_requests_user ON vip_requests (user_id);
+CREATE TABLE IF NOT EXISTS child_bots (token TEXT PRIMARY KEY, name TEXT, owner_id INTEGER NOT NULL, username TEXT, approved_by INTEGER, created_at TEXT);
+CREATE INDEX IF NOT EXISTS idx_child_bots_owner ON child_bots (owner_id);
+CREATE TABLE IF NOT EXISTS bot_registrations (request_code TEXT PRIMARY KEY, user_id INTEGER NOT NULL, user_first_name TEXT, bot_name TEXT, bot_token TEXT, bot_username TEXT);
+CREATE INDEX IF NOT EXISTS idx_bot_registrations_user ON bot_registrations (user_id);
+CREATE TABLE IF NOT EXISTS custom_commands (name TEXT PRIMARY KEY, response TEXT NOT NULL, permission TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS prized_items (name TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS media_cache (asset TEXT PRIMARY KEY, path TEXT, file_ids TEXT);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS trackers (chat_id INTEGER PRIMARY KEY, bot_token TEXT NOT NULL, filters TEXT, is_muted INTEGER NOT NULL DEFAULT 0, first_name TEXT, version TEXT, last_hash TEXT);
+CREATE INDEX IF NOT EXISTS idx_trackers_bot ON trackers (bot_token);
+"""
+ROLE_FILES = {'authorized': "authorized_users.txt", 'admin': "admins.txt", 'banned': "banned_users.txt", 'restricted': "restricted_users.txt"}
+
+class StateStore:
+    def __init__(self, filename: str):
+        self.filename, self.conn, self.lock = filename, None, Lock()
+
+    def open(self):
+        self.conn = sqlite3.connect(get_data_filepath(self.filename), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(STATE_SCHEMA)
+
+    def close(self):
+        if self.conn is not None:
+            with self.lock: self.conn.close()
+            self.conn = None
+
+    def load(self, table: str, **where) -> dict:
+        keys, columns = STATE_TABLES[table]
+        sql = f"SELECT {', '.join(keys + columns)} FROM {table}" + (" WHERE " + " AND ".join(f"{c} = ?" for c in where) if where else "")
+        with self.lock: rows = self.conn.execute(sql, list(where.values())).fetchall()
+        loaded = {}
+        for row in rows:
+            key = row[keys[0]] if len(keys) == 1 else tuple(row[k] for k in keys)
+            loaded[key] = {c: json.loads(row[c]) if c in JSON_COLUMNS and row[c] is not None else row[c] for c in columns}
+        return loaded
+
+    def get_setting(self, key: str, default=None):
+        with self.lock: row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row['value']) if row and row['value'] is not None else default
+
+    def apply(self, batch):
+        with self.lock, self.conn:
+            for table, key, row in batch:
+                keys, columns = STATE_TABLES[table]
+                key_values = list(key) if isinstance(key, tuple) else [key]
+                if row is None:
+                    self.conn.execute(f"DELETE FROM {table} WHERE " + " AND ".join(f"{k} = ?" for k in keys), key_values)
+                    continue
+                values = [json.dumps(row.get(c)) if c in JSON_COLUMNS else row.get(c) for c in columns]
+                sql = f"INSERT INTO {table} ({', '.join(keys + columns)}) VALUES ({', '.join('?' * (len(keys) + len(columns)))})"
+                sql += f" ON CONFLICT ({', '.join(keys)}) " + ("DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in columns) if columns else "DO NOTHING")
+                self.conn.execute(sql, key_values + values)
+
+    def migrate_from_files(self):
+        """Imports the legacy flat files once; they are left in place untouched as a backup."""
+        if self.get_setting('migrated_from_files'): return
+        batch = []
+        for role, filename in ROLE_FILES.items(): batch += [('user_roles', (user_id, role), {}) for user_id in load_int_set_from_file(filename)]
+        batch += [('prized_items', name, {}) for name in load_set_from_file("prized_items.txt")]
+        batch += [('users', int(uid), info) for uid, info in load_json_from_file("user_info.json").items() if uid.lstrip('-').isdigit()]
+        batch += [('vips', int(uid), {'expires_at': expires_at}) for uid, expires_at in load_json_from_file("vips.json").items()]
+        batch += [('vip_requests', code, {'user_id': user_id}) for code, user_id in load_json_from_file("vip_requests.json").items()]
+        batch += [('child_bots', token, info) for token, info in load_json_from_file("child_bots.json").items()]
+        batch += [('bot_registrations', code, info) for code, info in load_json_from_file("bot_registrations.json").items()]
+        batch += [('custom_commands', name, info) for name, info in load_json_from_file("custom_commands.json").items()]
+        version_filepath = get_data_filepath("version.txt")
+        if os.path.exists(version_filepath):
+            with open(version_filepath, 'r') as f: batch.append(('settings', 'last_known_version', {'value': f.read().strip()}))
+        update_flag = load_json_from_file("update_flag.json")
+        if update_flag: batch.append(('settings', 'update_flag', {'value': update_flag}))
+        batch.append(('settings', 'migrated_from_files', {'value': datetime.now(pytz.utc).isoformat()}))
+        self.apply(batch)
+        logger.info(f"Migrated {len(batch) - 1} rows from flat files into {self.filename}.")
+
+STATE_STORE = StateStore(STATE_DB_FILE)
+PENDING_WRITES, PERSIST_TASK = {}, None
+
+def save_row(table: str, key, row: dict | None = None):
+    PENDING_WRITES[(table, key)] = row if row is not None else {}
+
+def delete_row(table: str, key):
+    PENDING_WRITES[(table, key)] = None
+
+def save_setting(key: str, value):
+    save_row('settings', key, {'value': value})
+
+def persist_role(user_id: int, role: str, enabled: bool):
+    ACCESS_CACHE.pop(user_id, None)
+    if enabled: save_row('user_roles', (user_id, role))
+    else: delete_row('user_roles', (user_id, role))
+
+def take_pending_writes() -> list:
+    # Rows are copied on the event loop so the writer thread never reads a dict a handler is mutating.
+    batch = [(table, key, dict(row) if row is not None else None) for (table, key), row in PENDING_WRITES.items()]
+    PENDING_WRITES.clear()
+    return batch
+
+def write_batch(batch) -> bool:
+    try: STATE_STORE.apply(batch); return True
+    except sqlite3.IntegrityError:
+        # One bad row must not block every other write behind it, so retry row by row and drop the offenders.
+        for table, key, row in batch:
+            try: STATE_STORE.apply([(table, key, row)])
+            except sqlite3.IntegrityError as e: logger.error(f"Dropping invalid {table} row {key}: {e}")
+        return True
+    except Exception as e: logger.error(f"Failed to persist {len(batch)} state rows: {e}"); return False
+
+async def persistence_loop():
+    while True:
+        await asyncio.sleep(PERSIST_FLUSH_SECONDS)
+        if STOCK_HISTORY.pending: await asyncio.to_thread(STOCK_HISTORY.record, STOCK_HISTORY.take_pending())
+        if not PENDING_WRITES: continue
+        batch = take_pending_writes()
+        if not await asyncio.to_thread(write_batch, batch):
+            for table, key, row in batch: PENDING_WRITES.setdefault((table, key), row)
+
+def ensure_persistence():
+    global PERSIST_TASK
+    if PERSIST_TASK is None or PERSIST_TASK.done(): PERSIST_TASK = asyncio.create_task(persistence_loop())
+
+def prepare_for_exec():
+    """Flushes state and stops shard workers right before the process replaces itself via os.execv."""
+    flush_pending_writes(); SUPERVISOR.terminate_workers()
+
+def flush_pending_writes():
+    """Synchronously writes everything still pending; used on shutdown and before re-exec."""
+    if PENDING_WRITES and STATE_STORE.conn is not None: write_batch(take_pending_writes())
+    if STOCK_HISTORY.pending and STOCK_HISTORY.conn is not None: STOCK_HISTORY.record(STOCK_HISTORY.take_pending())
+
+def load_all_data(log: bool = True):
+    global AUTHORIZED_USERS, ADMIN_USERS, BANNED_USERS, RESTRICTED_USERS, PRIZED_ITEMS, LAST_KNOWN_VERSION, CUSTOM_COMMANDS, VIP_REQUESTS, USER_INFO_CACHE, CHILD_BOTS, BOT_REGISTRATION_REQUESTS, MEDIA_CACHE
+    if STATE_STORE.conn is None: STATE_STORE.open()
+    if STOCK_HISTORY.conn is None: STOCK_HISTORY.open()
+    STATE_STORE.migrate_from_files()
+    roles = {role: set() for role in ROLE_FILES}
+    for user_id, role in STATE_STORE.load('user_roles'): roles.setdefault(role, set()).add(user_id)
+    AUTHORIZED_USERS, ADMIN_USERS, BANNED_USERS, RESTRICTED_USERS = roles['authorized'], roles['admin'], roles['banned'], roles['restricted']
+    PRIZED_ITEMS = set(STATE_STORE.load('prized_items'))
+    if not PRIZED_ITEMS:
+        # The defaults are stored as rows, so /addprized and /delprized edit them rather than replace them.
+        PRIZED_ITEMS = {"master sprinkler", "beanstalk", "advanced sprinkler", "godly sprinkler", "ember lily"}
+        STATE_STORE.apply([('prized_items', name, {}) for name in PRIZED_ITEMS])
     if BOT_OWNER_ID: AUTHORIZED_USERS.add(BOT_OWNER_ID); ADMIN_USERS.add(BOT_OWNER_ID)
-    VIP_USERS = load_json_from_file("vips.json")
-    USER_INFO_CACHE = load_json_from_file("user_info.json")
-    CUSTOM_COMMANDS = load_json_from_file("custom_commands.json")
-    VIP_REQUESTS = load_json_from_file("vip_requests.json")
-    CHILD_BOTS = load_json_from_file("child_bots.json")
-    BOT_REGISTRATION_REQUESTS = load_json_from_file("bot_registrations.json")
-    version_filepath = get_data_filepath("version.txt")
-    if os.path.exists(version_filepath):
-        with open(version_filepath, 'r') as f: LAST_KNOWN_VERSION = f.read().strip()
-    logger.info(f"Loaded {len(AUTHORIZED_USERS)} users, {len(ADMIN_USERS)} admins, and {len(CHILD_BOTS)} child bots.")
-
-async def log_user_activity(user: User, command: str, bot: Bot):
+    ACCESS_CACHE.clear()
+    VIP_USERS.replace({user_id: datetime.fromisoformat(row['expires_at']) for user_id, row in STATE_STORE.load('vips').items()})
+    USER_INFO_CACHE = UserInfoCache()
+    CUSTOM_COMMANDS = STATE_STORE.load('custom_commands')
+    VIP_REQUESTS = {code: row['user_id'] for code, row in STATE_STORE.load('vip_requests').items()}
+    CHILD_BOTS = STATE_STORE.load('child_bots')
+    BOT_REGISTRATION_REQUESTS = STATE_STORE.load('bot_registrations')
+    MEDIA_CACHE = STATE_STORE.load('media_cache')
+    LAST_KNOWN_VERSION = STATE_STORE.get_setting('last_known_version', "")
+    if log: logger.info(f"Loaded {len(AUTHORIZED_USERS)} users, {len(ADMIN_USERS)} admins, and {len(CHILD_BOTS)} child bots.")
+
+# --- USER PROFILES ---
+# Only recently active users stay in memory; the rest are read back from the store on demand. Avatars
+# are looked up by a background worker, so commands never wait on Telegram for profile bookkeeping.
+class UserInfoCache(OrderedDict):
+    """LRU view over the users table, keyed by the user id as a string."""
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        super().__init__(); self.max_size = max_size
+
+    def _fetch(self, key: str) -> dict | None:
+        if dict.__contains__(self, key): self.move_to_end(key); return dict.__getitem__(self, key)
+        # A row still waiting to be written is newer than what the store holds.
+        row = PENDING_WRITES.get(('users', int(key))) or (STATE_STORE.load('users', user_id=int(key)).get(int(key)) if STATE_STORE.conn is not None else None)
+        if row is None: return None
+        row = {k: v for k, v in row.items() if v is not None}; self[key] = row
+        return row
+
+    def get(self, key, default=None): return d if (d := self._fetch(str(key))) is not None else default
+    def __contains__(self, key) -> bool: return self._fetch(str(key)) is not None
+
+    def __getitem__(self, key):
+        if (row := self._fetch(str(key))) is None: raise KeyError(key)
+        return row
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value); self.move_to_end(key)
+        while len(self) > self.max_size: self.popitem(last=False)
+
+USER_INFO_CACHE = UserInfoCache()
+
+class ProfileRefresher:
+    """Batched, rate-limited avatar lookups for users whose cached profile is older than PROFILE_TTL_SECONDS."""
+    def __init__(self):
+        self.pending, self.task = OrderedDict(), None
+
+    def request(self, user_id: int, bot: Bot):
+        if user_id not in self.pending: self.pending[user_id] = bot
+
+    async def run(self):
+        bucket = TokenBucket(PROFILE_REFRESH_RATE, PROFILE_REFRESH_RATE)
+        while True:
+            await asyncio.sleep(PROFILE_REFRESH_SECONDS)
+            batch = [self.pending.popitem(last=False) for _ in range(min(PROFILE_REFRESH_BATCH, len(self.pending)))]
+            for user_id, bot in batch:
+                await bucket.acquire()
+                try: await self.refresh(user_id, bot)
+                except RetryAfter as e: self.pending[user_id] = bot; await asyncio.sleep(e.retry_after)
+                except Exception as e: logger.warning(f"Could not refresh profile for {user_id}. Error: {e}")
+
+    async def refresh(self, user_id: int, bot: Bot):
+        p_photos = await bot.get_user_profile_photos(user_id, limit=1)
+        avatar_path = (await p_photos.photos[0][0].get_file()).file_path if p_photos and p_photos.photos and p_photos.photos[0] else None
+        user_info = USER_INFO_CACHE.get(str(user_id))
+        if user_info is None: return
+        user_info.update(avatar_path=avatar_path, timestamp=datetime.now(pytz.utc).isoformat())
+        save_row('users', user_id, user_info)
+
+PROFILE_REFRESHER = ProfileRefresher()
+
+def ensure_profile_refresher():
+    if PROFILE_REFRESHER.task is None or PROFILE_REFRESHER.task.done(): PROFILE_REFRESHER.task = asyncio.create_task(PROFILE_REFRESHER.run())
+
+def log_user_activity(user: User, command: str, bot: Bot):
     if not user: return
-    avatar_url = "https://i.imgur.com/jpfrJd3.png"
+    avatar_url = DEFAULT_AVATAR_URL
     try:
         user_id_str = str(user.id)
-        if user_id_str not in USER_INFO_CACHE or (datetime.now(pytz.utc) - datetime.fromisoformat(USER_INFO_CACHE[user_id_str].get('timestamp', '1970-01-01T00:00:00+00:00'))).total_seconds() > 3600:
-            p_photos = await bot.get_user_profile_photos(user.id, limit=1)
-            avatar_path = (await p_photos.photos[0][0].get_file()).file_path if p_photos and p_photos.photos and p_photos.photos[0] else None
-            existing_info = USER_INFO_CACHE.get(user_id_str, {})
-            USER_INFO_CACHE[user_id_str] = {'first_name': user.first_name, 'username': user.username or "N/A", 'avatar_path': avatar_path, 'timestamp': datetime.now(pytz.utc).isoformat(), 'command_count': existing_info.get('command_count', 0), 'approved_date': existing_info.get('approved_date')}
-        user_info = USER_INFO_CACHE[user_id_str]
+        user_info = USER_INFO_CACHE.get(user_id_str)
+        if user_info is None: user_info = USER_INFO_CACHE[user_id_str] = {}
+        user_info.update(first_name=user.first_name, username=user.username or "N/A")
         user_info['command_count'] = user_info.get('command_count', 0) + 1
+        if (datetime.now(pytz.utc) - datetime.fromisoformat(user_info.get('timestamp', '1970-01-01T00:00:00+00:00'))).total_seconds() > PROFILE_TTL_SECONDS: PROFILE_REFRESHER.request(user.id, bot)
         if user_info.get('avatar_path'): avatar_url = f"https://api.telegram.org/file/bot{bot.token}/{user_info['avatar_path']}"
         activity_log = {"user_id": user.id, "first_name": user_info['first_name'], "username": user_info['username'], "command": command, "timestamp": datetime.now(pytz.utc).isoformat(), "avatar_url": avatar_url}
         USER_ACTIVITY.insert(0, activity_log); del USER_ACTIVITY[50:]
-        save_json_to_file("user_info.json", USER_INFO_CACHE)
+        DASHBOARD_HUB.publish('activity', activity_log)
+        save_row('users', user.id, user_info)
     except Exception as e: logger.warning(f"Could not log activity for {user.id}. Error: {e}")
 
+# --- VIP MEMBERSHIP ---
+# Expiries are parsed once into a dict for O(1) checks and a heap ordered by expiry. One task sleeps
+# until the earliest expiry, then stops that user's tracker and tells them; nothing rescans the table.
+class VipIndex:
+    def __init__(self):
+        self.expires: dict[int, datetime] = {}
+        self.heap: list[tuple[datetime, int]] = []
+        self.changed, self.task = asyncio.Event(), None
+
+    def __len__(self) -> int: return len(self.expires)
+    def get(self, user_id: int) -> datetime | None: return self.expires.get(user_id)
+
+    def is_active(self, user_id: int) -> bool:
+        expires_at = self.expires.get(user_id)
+        return expires_at is not None and expires_at > datetime.now(pytz.utc)
+
+    def replace(self, expiries: dict[int, datetime]):
+        self.expires = dict(expiries)
+        self.heap = [(expires_at, user_id) for user_id, expires_at in self.expires.items()]; heapq.heapify(self.heap)
+        self.changed.set()
+
+    def set(self, user_id: int, expires_at: datetime):
+        # A previous entry for the user stays in the heap and is discarded when it reaches the top.
+        self.expires[user_id] = expires_at; heapq.heappush(self.heap, (expires_at, user_id))
+        save_row('vips', user_id, {'expires_at': expires_at.isoformat()}); self.changed.set()
+
+    def remove(self, user_id: int):
+        if self.expires.pop(user_id, None) is not None: delete_row('vips', user_id)
+
+    def pop_due(self, now: datetime) -> list[int]:
+        due = []
+        while self.heap and (self.heap[0][0] <= now or self.expires.get(self.heap[0][1]) != self.heap[0][0]):
+            expires_at, user_id = heapq.heappop(self.heap)
+            if self.expires.get(user_id) == expires_at: del self.expires[user_id]; due.append(user_id)
+        return due
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            due = self.pop_due(datetime.now(pytz.utc))
+            if due: await asyncio.gather(*(expire_vip(user_id) for user_id in due))
+            delay = (self.heap[0][0] - datetime.now(pytz.utc)).total_seconds() if self.heap else None
+            try: await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError: pass
+
+VIP_USERS = VipIndex()
+
+def is_vip(user_id: int) -> bool: return VIP_USERS.is_active(user_id)
+
+async def expire_vip(user_id: int):
+    # Every shard expires its own trackers, but only shard 0 writes, so the row is deleted once.
+    if BOT_SHARD_INDEX == 0: delete_row('vips', user_id)
+    tracker_info = ACTIVE_TRACKERS.get(user_id)
+    if tracker_info is None or not stop_tracking(user_id): return
+    logger.info(f"VIP membership of {user_id} expired; stopped their tracker.")
+    try: await get_dispatcher(tracker_info['bot']).send('send_message', user_id, text="⌛ <b>Your VIP membership has expired.</b>\n\nYour background tracker has been stopped. Use /requestvip to renew it.", parse_mode=ParseMode.HTML)
+    except Exception as e: logger.error(f"Failed to send VIP expiry notice to {user_id}: {e}")
+
+def ensure_vip_expiry():
+    if VIP_USERS.task is None or VIP_USERS.task.done(): VIP_USERS.task = asyncio.create_task(VIP_USERS.run())
+
 # --- HELPER & CORE BOT FUNCTIONS ---
+ITEM_EMOJIS = {"Common Egg": "🥚", "Uncommon Egg": "🐣", "Rare Egg": "🍳", "Legendary Egg": "🪺", "Mythical Egg": "🥚", "Bug Egg": "🪲", "Watering Can": "🚿", "Trowel": "🛠️", "Recall Wrench": "🔧", "Basic Sprinkler": "💧", "Advanced Sprinkler": "💦", "Godly Sprinkler": "⛲", "Lightning Rod": "⚡", "Master Sprinkler": "🌊", "Favorite Tool": "❤️", "Harvest Tool": "🌾", "Carrot": "🥕", "Strawberry": "🍓", "Blueberry": "🫐", "Orange Tulip": "🌷", "Tomato": "🍅", "Corn": "🌽", "Daffodil": "🌼", "Watermelon": "🍉", "Pumpkin": "🎃", "Apple": "🍎", "Bamboo": "🎍", "Coconut": "🥥", "Cactus": "🌵", "Dragon Fruit": "🍈", "Mango": "🥭", "Grape": "🍇", "Mushroom": "🍄", "Pepper": "🌶️", "Cacao": "🍫", "Beanstalk": "🌱", "Ember Lily": "🔥"}
+CATEGORY_HEADERS = {"Gear": "🛠️ 𝗚𝗲𝗮𝗿", "Seed": "🌱 𝗦𝗲𝗲𝗱𝘀", "Egg": "🥚 𝗘𝗴𝗴𝘀", "Cosmetics": "🎨 𝗖𝗼𝘀𝗺𝗲𝘁𝗶𝗰𝘀", "Honey": "🍯 𝗛𝗼𝗻𝗲𝘆"}
 def get_ph_time()->datetime: return datetime.now(PHT)
 def format_value(val: int) -> str:
     if val >= 1_000_000: return f"x{(val / 1_000_000):.1f}M"
     if val >= 1_000: return f"x{(val / 1_000):.1f}K"
     return f"x{val}"
 def add_emoji(name: str) -> str:
-    emojis = {"Common Egg": "🥚", "Uncommon Egg": "🐣", "Rare Egg": "🍳", "Legendary Egg": "🪺", "Mythical Egg": "🥚", "Bug Egg": "🪲", "Watering Can": "🚿", "Trowel": "🛠️", "Recall Wrench": "🔧", "Basic Sprinkler": "💧", "Advanced Sprinkler": "💦", "Godly Sprinkler": "⛲", "Lightning Rod": "⚡", "Master Sprinkler": "🌊", "Favorite Tool": "❤️", "Harvest Tool": "🌾", "Carrot": "🥕", "Strawberry": "🍓", "Blueberry": "🫐", "Orange Tulip": "🌷", "Tomato": "🍅", "Corn": "🌽", "Daffodil": "🌼", "Watermelon": "🍉", "Pumpkin": "🎃", "Apple": "🍎", "Bamboo": "🎍", "Coconut": "🥥", "Cactus": "🌵", "Dragon Fruit": "🍈", "Mango": "🥭", "Grape": "🍇", "Mushroom": "🍄", "Pepper": "🌶️", "Cacao": "🍫", "Beanstalk": "🌱", "Ember Lily": "🔥"}
-    return f"{emojis.get(name, '❔')} {name}"
+    return f"{ITEM_EMOJIS.get(name, '❔')} {name}"
 def format_timedelta(td: timedelta, short=False) -> str:
     total_seconds = int(td.total_seconds())
     if total_seconds < 0: total_seconds = 0
@@ -154,124 +515,983 @@ def calculate_next_restock_times() -> dict[str, datetime]:
     else: next_cosmetic_time = (next_cosmetic_time + timedelta(days=1)).replace(hour=0)
     next_times["Cosmetics"] = next_cosmetic_time
     return next_times
-def format_category_message(category_name: str, items: list, restock_timer: str) -> str:
-    header_emojis = {"Gear": "🛠️ 𝗚𝗲𝗮𝗿", "Seed": "🌱 𝗦𝗲𝗲𝗱𝘀", "Egg": "🥚 𝗘𝗴𝗴𝘀", "Cosmetics": "🎨 𝗖𝗼𝘀𝗺𝗲𝘁𝗶𝗰𝘀", "Honey": "🍯 𝗛𝗼𝗻𝗲𝘆"}
-    header = f"{header_emojis.get(category_name, '📦 Stock')}"
-    item_list = "\n".join([f"• {add_emoji(i['name'])}: {format_value(i['value'])}" for i in items]) if items else "<i>No items currently in stock.</i>"
-    return f"<b>{header}</b>\n\n{item_list}\n\n⏳ Restock In: {restock_timer}"
-def format_weather_message(weather_data: dict) -> str:
-    icon = weather_data.get("icon", "❓")
-    name = weather_data.get("name", "Unknown")
-    bonus = weather_data.get("cropBonuses", "None")
-    return f"{icon} <b>Current Weather:</b> {name}\n🌾 <b>Crop Bonus:</b> {bonus}"
-async def fetch_all_data() -> dict | None:
+def format_category_message(category_name: str, items: list) -> str:
+    header = f"{CATEGORY_HEADERS.get(category_name, '📦 Stock')}"
+    item_list = "\n".join([f"• {add_emoji(i.name)}: {format_value(i.value)}" for i in items]) if items else "<i>No items currently in stock.</i>"
+    return f"<b>{header}</b>\n\n{item_list}"
+def format_change_message(category_name: str, events: list) -> str:
+    header = f"{CATEGORY_HEADERS.get(category_name, '📦 Stock')}"
+    lines = []
+    for e in events:
+        if e.kind == 'appeared': lines.append(f"🆕 {add_emoji(e.name)}: {format_value(e.new_value)}")
+        elif e.kind == 'disappeared': lines.append(f"❌ {add_emoji(e.name)}: sold out")
+        else: lines.append(f"🔁 {add_emoji(e.name)}: {format_value(e.old_value)} → {format_value(e.new_value)}")
+    return f"🔄 <b>{header} updated!</b>\n\n" + "\n".join(lines)
+def format_restock_footer(restock_timer: str) -> str:
+    return f"\n\n⏳ Restock In: {restock_timer}"
+def format_weather_message(weather: 'Weather') -> str:
+    return f"{weather.icon} <b>Current Weather:</b> {weather.name}\n🌾 <b>Crop Bonus:</b> {weather.crop_bonuses}"
+
+# --- STOCK SNAPSHOTS ---
+# Item names are interned once to small integer ids with their lowercase form precomputed.
+# A parsed Snapshot is immutable, so every tracker that has seen it holds the same object.
+ITEM_NAMES, ITEM_KEYS, ITEM_IDS = [], [], {}
+
+def intern_item(name: str) -> int:
+    item_id = ITEM_IDS.get(name)
+    if item_id is None:
+        item_id = ITEM_IDS[name] = len(ITEM_NAMES)
+        ITEM_NAMES.append(sys.intern(name)); ITEM_KEYS.append(sys.intern(name.lower()))
+    return item_id
+
+class StockItem(NamedTuple):
+    item_id: int
+    value: int
+
+    @property
+    def name(self) -> str: return ITEM_NAMES[self.item_id]
+
+    @property
+    def key(self) -> str: return ITEM_KEYS[self.item_id]
+
+class Weather(NamedTuple):
+    name: str = "Unknown"
+    icon: str = "❓"
+    crop_bonuses: str = "None"
+
+class Snapshot:
+    """One upstream stock + weather reading; `stock` maps a category to a tuple of StockItems."""
+    __slots__ = ('stock', 'weather', 'digest')
+
+    def __init__(self, stock: dict[str, tuple[StockItem, ...]], weather: Weather, digest: str | None = None):
+        object.__setattr__(self, 'stock', MappingProxyType(stock))
+        object.__setattr__(self, 'weather', weather)
+        object.__setattr__(self, 'digest', digest)
+
+    def __setattr__(self, name, value): raise AttributeError(f"Snapshot is immutable, cannot set {name}")
+
+    @classmethod
+    def from_items(cls, stock: dict[str, list[tuple[str, int]]], weather: Weather, digest: str | None = None) -> 'Snapshot':
+        return cls({sys.intern(cat): tuple(StockItem(intern_item(name), int(value)) for name, value in items) for cat, items in stock.items()}, weather, digest)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Snapshot':
+        weather = data.get("weather") or {}
+        return cls.from_items({cat: [(i['name'], i['value']) for i in items] for cat, items in data.get("stock", {}).items()},
+                              Weather(weather.get("name", "Unknown"), weather.get("icon", "❓"), weather.get("cropBonuses", "None")), data.get("digest"))
+
+    def to_dict(self) -> dict:
+        return {"stock": {cat: [{'name': i.name, 'value': i.value} for i in items] for cat, items in self.stock.items()},
+                "weather": {"name": self.weather.name, "icon": self.weather.icon, "cropBonuses": self.weather.crop_bonuses}, "digest": self.digest}
+
+# --- RENDER CACHE ---
+# Alert bodies depend only on the snapshot, the category and the recipient's filter set, so each
+# distinct body is formatted once and reused for every recipient; the ticking restock countdown is
+# appended outside the cache. The cache is dropped as soon as a different snapshot is rendered.
+RENDER_CACHE = {'snapshot': None, 'entries': {}}
+NEXT_RESTOCK_CACHE = {'until': None, 'times': {}}
+
+def render_cached(snapshot: Snapshot, key: tuple, build) -> str:
+    if RENDER_CACHE['snapshot'] is not snapshot: RENDER_CACHE['snapshot'] = snapshot; RENDER_CACHE['entries'] = {}
+    text = RENDER_CACHE['entries'].get(key)
+    if text is None: text = RENDER_CACHE['entries'][key] = build()
+    return text
+
+def restock_countdown(category_name: str) -> str:
+    now = get_ph_time()
+    if NEXT_RESTOCK_CACHE['until'] is None or now >= NEXT_RESTOCK_CACHE['until']:
+        NEXT_RESTOCK_CACHE['times'] = calculate_next_restock_times(); NEXT_RESTOCK_CACHE['until'] = min(NEXT_RESTOCK_CACHE['times'].values())
+    return format_timedelta(NEXT_RESTOCK_CACHE['times'].get(category_name, now) - now, short=True)
+
+def render_category(snapshot: Snapshot, category_name: str, filters: list[str]) -> str | None:
+    """Returns the category message for a filter set, or None when nothing in it matches."""
+    def build():
+        items_to_show = [item for item in snapshot.stock.get(category_name, ()) if not filters or any(f in item.key for f in filters)]
+        return format_category_message(category_name, items_to_show) if items_to_show else ""
+    body = render_cached(snapshot, ('category', category_name, tuple(sorted(filters))), build)
+    return body + format_restock_footer(restock_countdown(category_name)) if body else None
+
+def render_weather(snapshot: Snapshot) -> str:
+    return render_cached(snapshot, ('weather',), lambda: format_weather_message(snapshot.weather))
+
+# --- SHARED HTTP CLIENT ---
+# A single pooled keep-alive client is reused for every upstream call so polls don't pay
+# for a fresh TCP+TLS handshake each time. HTTP/2 is only enabled if the h2 package exists.
+HTTP_CLIENT = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None or HTTP_CLIENT.is_closed:
+        HTTP_CLIENT = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS),
+        )
+    return HTTP_CLIENT
+
+async def close_http_client():
+    global HTTP_CLIENT
+    if HTTP_CLIENT is not None and not HTTP_CLIENT.is_closed: await HTTP_CLIENT.aclose()
+    HTTP_CLIENT = None
+
+# Upstream validators and the last payload per URL. A 304, or a body whose digest matches the
+# previous one, means nothing changed and the previously parsed snapshot object is returned as-is.
+UPSTREAM_CACHE, LAST_SNAPSHOT = {}, None
+
+async def fetch_upstream(url: str) -> bool:
+    cache = UPSTREAM_CACHE.setdefault(url, {})
+    headers = {}
+    if cache.get('etag'): headers['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'): headers['If-Modified-Since'] = cache['last_modified']
+    res = await get_http_client().get(url, headers=headers)
+    if res.status_code == 304 and 'payload' in cache: return False
+    res.raise_for_status()
+    cache['etag'], cache['last_modified'] = res.headers.get('ETag'), res.headers.get('Last-Modified')
+    digest = hashlib.blake2b(res.content, digest_size=16).digest()
+    if digest == cache.get('digest') and 'payload' in cache: return False
+    cache['payload'] = res.json(); cache['digest'] = digest
+    return True
+
+def parse_snapshot(stock_payload: dict, weather_data_raw, digest: str | None = None) -> Snapshot:
+    stock_data_raw = stock_payload['data']
+    weather = Weather()
+    if isinstance(weather_data_raw, dict):
+        weather = Weather(weather_data_raw.get("currentWeather", "Unknown"), weather_data_raw.get("icon", "❓"), weather_data_raw.get("cropBonuses", "None"))
+    stock = {cat.capitalize(): [(item['name'], item['quantity']) for item in details.get('items', [])] for cat, details in stock_data_raw.items() if 'items' in details}
+    return Snapshot.from_items(stock, weather, digest)
+
+async def fetch_all_data() -> Snapshot | None:
+    """Returns the latest snapshot; the very same object is returned while upstream is unchanged."""
+    global LAST_SNAPSHOT
+    if BOT_SHARD_INDEX: return load_shared_snapshot()
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            stock_res, weather_res = await asyncio.gather(client.get(API_STOCK_URL), client.get(API_WEATHER_URL))
-            stock_res.raise_for_status(); weather_res.raise_for_status()
-            stock_data_raw, weather_data_raw = stock_res.json()['data'], weather_res.json()
-            
-            weather_name = "Unknown"; weather_icon = "❓"; weather_bonus = "None"
-            if isinstance(weather_data_raw, dict):
-                weather_name = weather_data_raw.get("currentWeather", "Unknown")
-                weather_icon = weather_data_raw.get("icon", "❓")
-                weather_bonus = weather_data_raw.get("cropBonuses", "None")
-
-            all_data = {"stock": {}, "weather": {"name": weather_name, "icon": weather_icon, "cropBonuses": weather_bonus}}
-            for cat, details in stock_data_raw.items():
-                if 'items' in details: all_data["stock"][cat.capitalize()] = [{'name': item['name'], 'value': int(item['quantity'])} for item in details.get('items', [])]
-            return all_data
+        await asyncio.gather(fetch_upstream(API_STOCK_URL), fetch_upstream(API_WEATHER_URL))
+        # Compared with the published snapshot rather than per-URL change flags: if one request or the parse
+        # failed after the other URL's cache moved on, the next poll still builds the new snapshot.
+        digest = hashlib.blake2b(UPSTREAM_CACHE[API_STOCK_URL]['digest'] + UPSTREAM_CACHE[API_WEATHER_URL]['digest'], digest_size=16).hexdigest()
+        if LAST_SNAPSHOT is not None and LAST_SNAPSHOT.digest == digest: return LAST_SNAPSHOT
+        LAST_SNAPSHOT = parse_snapshot(UPSTREAM_CACHE[API_STOCK_URL]['payload'], UPSTREAM_CACHE[API_WEATHER_URL]['payload'], digest)
+        # Kept durably so trackers restored after a restart can diff against what they last saw.
+        save_setting('last_snapshot', LAST_SNAPSHOT.to_dict())
+        return LAST_SNAPSHOT
     except Exception as e: logger.error(f"Error fetching all data: {e}"); return None
-async def send_music_vm(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+
+def load_shared_snapshot() -> Snapshot | None:
+    """Worker shards read the snapshot shard 0 stored instead of polling upstream themselves."""
+    global LAST_SNAPSHOT
     try:
-        ydl_opts = {'format': 'bestaudio/best', 'outtmpl': f'{chat_id}_%(title)s.%(ext)s', 'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}], 'quiet': True}
-        loop = asyncio.get_running_loop()
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl: info = await loop.run_in_executor(None, lambda: ydl.extract_info(MULTOMUSIC_URL, download=True)); filename = ydl.prepare_filename(info).replace('.webm', '.mp3').replace('.m4a', '.mp3')
-        await context.bot.send_audio(chat_id=chat_id, audio=open(filename, 'rb'), title="Multo", performer="Cup of Joe"); os.remove(filename)
+        saved = STATE_STORE.get_setting('last_snapshot')
+        if saved and (LAST_SNAPSHOT is None or saved.get('digest') != LAST_SNAPSHOT.digest): LAST_SNAPSHOT = Snapshot.from_dict(saved)
+        return LAST_SNAPSHOT
+    except Exception as e: logger.error(f"Error reading the shared snapshot: {e}"); return None
+
+# --- MEDIA CACHE ---
+# Each asset is downloaded and transcoded once into DATA_DIR/MEDIA_DIR. After the first upload
+# through a bot, Telegram's file_id is remembered per bot (file_ids are bot-specific), so later
+# sends are a single API call that reuses it.
+MEDIA_ASSETS = {
+    'multo': {'url': MULTOMUSIC_URL, 'method': 'send_audio', 'field': 'audio', 'ext': 'mp3', 'ydl_opts': {'format': 'bestaudio/best', 'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}]}},
+    'welcome_video': {'url': WELCOME_VIDEO_URL, 'method': 'send_video', 'field': 'video', 'ext': 'mp4', 'ydl_opts': {'format': 'best[ext=mp4][height<=720]/best[ext=mp4]/best'}},
+}
+
+MEDIA_POOL, MEDIA_JOBS = None, {}
+
+def download_media(url: str, ydl_opts: dict, ext: str) -> str:
+    # Runs inside a media worker process, so yt-dlp and its ffmpeg post-processing never touch the event loop.
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+        downloads = info.get('requested_downloads') or [{}]
+        return downloads[0].get('filepath') or os.path.splitext(ydl.prepare_filename(info))[0] + f".{ext}"
+
+def get_media_pool() -> ProcessPoolExecutor:
+    global MEDIA_POOL
+    if MEDIA_POOL is None: MEDIA_POOL = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return MEDIA_POOL
+
+def shutdown_media_pool():
+    global MEDIA_POOL
+    if MEDIA_POOL is not None: MEDIA_POOL.shutdown(wait=False, cancel_futures=True)
+    MEDIA_POOL = None
+
+async def run_media_job(key: str, func, *args):
+    """Runs func on the media pool; concurrent callers with the same key share one in-flight job."""
+    job = MEDIA_JOBS.get(key)
+    if job is None:
+        job = MEDIA_JOBS[key] = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(get_media_pool(), func, *args))
+        job.add_done_callback(lambda _: MEDIA_JOBS.pop(key, None))
+    return await asyncio.shield(job)
+
+def media_file_id(asset: str, bot: Bot) -> str | None:
+    return MEDIA_CACHE.get(asset, {}).get('file_ids', {}).get(bot.token.split(':')[0])
+
+async def ensure_media_file(asset: str) -> str:
+    entry = MEDIA_CACHE.setdefault(asset, {'path': None, 'file_ids': {}})
+    if entry.get('path') and os.path.exists(entry['path']): return entry['path']
+    spec = MEDIA_ASSETS[asset]
+    ydl_opts = {**spec['ydl_opts'], 'outtmpl': os.path.join(get_data_filepath(MEDIA_DIR), f"{asset}.%(ext)s"), 'quiet': True}
+    filename = await run_media_job(f"download:{asset}", download_media, spec['url'], ydl_opts, spec['ext'])
+    entry['path'] = filename; save_row('media_cache', asset, entry)
+    logger.info(f"Cached media asset '{asset}' at {filename}.")
+    return filename
+
+async def send_cached_media(bot: Bot, chat_id: int, asset: str, **kwargs):
+    spec, bot_key, dispatcher = MEDIA_ASSETS[asset], bot.token.split(':')[0], get_dispatcher(bot)
+    file_id = media_file_id(asset, bot)
+    if file_id:
+        try: return await dispatcher.send(spec['method'], chat_id, **{spec['field']: file_id}, **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for '{asset}' was rejected, re-uploading. Error: {e}")
+            MEDIA_CACHE[asset]['file_ids'].pop(bot_key, None); save_row('media_cache', asset, MEDIA_CACHE[asset])
+    path = await ensure_media_file(asset)
+    # A Path, not an open file: a retry after RetryAfter must re-read the file, not reuse a handle left at EOF.
+    message = await dispatcher.send(spec['method'], chat_id, **{spec['field']: Path(path)}, **kwargs)
+    sent_media = getattr(message, spec['field'], None)
+    if sent_media:
+        MEDIA_CACHE[asset].setdefault('file_ids', {})[bot_key] = sent_media.file_id; save_row('media_cache', asset, MEDIA_CACHE[asset])
+    return message
+
+async def send_music_vm(bot: Bot, chat_id: int):
+    try: await send_cached_media(bot, chat_id, 'multo', title="Multo", performer="Cup of Joe")
     except Exception as e: logger.error(f"Failed to send music to {chat_id}: {e}")
-async def tracking_loop(chat_id: int, bot: Bot, context: ContextTypes.DEFAULT_TYPE, filters: list[str]):
-    logger.info(f"Starting tracking for chat_id: {chat_id}")
-    try:
+
+# --- OUTBOUND MESSAGE DISPATCH ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity, self.tokens, self.updated = rate, capacity, capacity, time.monotonic()
+
+    async def acquire(self):
         while True:
-            await asyncio.sleep(TRACKING_INTERVAL_SECONDS)
-            tracker_info = ACTIVE_TRACKERS.get(chat_id)
-            if not tracker_info: break
-            is_muted = tracker_info.get('is_muted', True)
-            
-            new_data = await fetch_all_data()
-            if not new_data: continue
-
-            old_data = LAST_SENT_DATA.get(chat_id, {"stock": {}, "weather": {}})
-
-            if not is_muted and new_data.get("weather") != old_data.get("weather"):
-                weather_report = format_weather_message(new_data.get("weather", {}))
-                try: await bot.send_message(chat_id, text=f"🌦️ <b>The weather has changed!</b>\n\n{weather_report}", parse_mode=ParseMode.HTML)
-                except Exception as e: logger.error(f"Failed weather alert to {chat_id}: {e}")
-            
-            old_prized = {item['name'].lower() for cat in old_data.get('stock', {}).values() for item in cat}
-            new_prized = {item['name'].lower() for cat in new_data.get('stock', {}).values() for item in cat}
-            just_appeared = new_prized - old_prized
-            prized_items_in_stock = just_appeared.intersection(PRIZED_ITEMS)
-            if prized_items_in_stock and not is_muted:
-                item_details = [item for cat in new_data['stock'].values() for item in cat if item['name'].lower() in prized_items_in_stock]
-                alert_list = "\n".join([f"› {add_emoji(i['name'])}: {format_value(i['value'])}" for i in item_details])
-                alert_message = f"🚨 <b>PRIZED ITEM ALERT!</b> 🚨\n\n{alert_list}"
-                try: await bot.send_message(chat_id, text=alert_message, parse_mode=ParseMode.HTML); await send_music_vm(context, chat_id)
-                except Exception as e: logger.error(f"Failed prized alert to {chat_id}: {e}")
-            
-            for category_name, new_items in new_data["stock"].items():
-                old_items_set = {frozenset(item.items()) for item in old_data.get("stock", {}).get(category_name, [])}; new_items_set = {frozenset(item.items()) for item in new_items}
-                if old_items_set != new_items_set:
-                    if len(new_items_set - old_items_set) == 1 and any(item['name'].lower() in prized_items_in_stock for item in new_items): continue
-                    if not is_muted:
-                        items_to_show = [item for item in new_items if not filters or any(f in item['name'].lower() for f in filters)]
-                        if items_to_show:
-                            next_restock_times = calculate_next_restock_times()
-                            time_left = next_restock_times.get(category_name, get_ph_time()) - get_ph_time()
-                            countdown_str = format_timedelta(time_left, short=True)
-                            
-                            category_message = format_category_message(category_name, items_to_show, countdown_str)
-                            alert_message = f"🔄 <b>{category_name.upper()} HAS BEEN UPDATED!</b>"
-                            try: await bot.send_message(chat_id, text=alert_message, parse_mode=ParseMode.HTML); await bot.send_message(chat_id, text=category_message, parse_mode=ParseMode.HTML)
-                            except Exception as e: logger.error(f"Failed category alert to {chat_id}: {e}")
-            LAST_SENT_DATA[chat_id] = new_data
-    except asyncio.CancelledError: logger.info(f"Tracking loop for {chat_id} cancelled.")
-    finally:
-        if chat_id in ACTIVE_TRACKERS: del ACTIVE_TRACKERS[chat_id]
-        if chat_id in LAST_SENT_DATA: del LAST_SENT_DATA[chat_id]
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+            if self.tokens >= 1: self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def is_full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        return max(0.0, (1 - self.tokens - (time.monotonic() - self.updated) * self.rate) / self.rate)
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+        if self.tokens < 1: return False
+        self.tokens -= 1; return True
+
+def prune_full_buckets(buckets: dict):
+    # A full bucket carries no state, so dropping it and creating a new one later changes nothing.
+    for key in [key for key, bucket in buckets.items() if bucket.is_full()]: del buckets[key]
+
+class MessageDispatcher:
+    """Send queue for one bot token.
+
+    Every chat has its own FIFO of jobs and at most one entry in `ready`, so only one worker sends to
+    a chat at a time and messages to it keep their order. A chat whose bucket is empty is put back on
+    `ready` once a token is due instead of holding a worker. Each send also takes a token from the
+    bot-wide bucket, and a 429 pauses every worker for the requested retry_after before the job is retried.
+    """
+    def __init__(self, bot: Bot):
+        self.bot, self.ready, self.workers = bot, asyncio.Queue(), []
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chat_buckets, self.chat_jobs = {}, {}
+        self.paused_until, self.queued, self.sent, self.failed, self.retried = 0.0, 0, 0, 0, 0
+        self.recent_sends = deque(maxlen=1000)
+
+    def submit(self, method: str, chat_id: int, **kwargs) -> asyncio.Future:
+        if not self.workers: self.workers = [asyncio.create_task(self._worker()) for _ in range(SEND_WORKERS)]
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        # A chat has an entry in chat_jobs exactly while it is on `ready`, being sent to or waiting for a token.
+        jobs = self.chat_jobs.get(chat_id)
+        if jobs is None: jobs = self.chat_jobs[chat_id] = deque(); self.ready.put_nowait(chat_id)
+        jobs.append((method, kwargs, future)); self.queued += 1
+        return future
+
+    async def send(self, method: str, chat_id: int, **kwargs):
+        return await self.submit(method, chat_id, **kwargs)
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= SEND_CHAT_BUCKETS_MAX: prune_full_buckets(self.chat_buckets)
+            bucket = self.chat_buckets[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            if (wait := self.chat_bucket(chat_id).wait_time()) > 0:
+                asyncio.get_running_loop().call_later(wait, self.ready.put_nowait, chat_id); continue
+            jobs = self.chat_jobs[chat_id]
+            method, kwargs, future = jobs.popleft()
+            try:
+                result = await self._send(method, chat_id, kwargs)
+                if not future.done(): future.set_result(result)
+            except Exception as e:
+                self.failed += 1
+                if not future.done(): future.set_exception(e)
+            finally:
+                self.queued -= 1
+                if jobs: self.ready.put_nowait(chat_id)
+                else: del self.chat_jobs[chat_id]
+
+    async def _send(self, method: str, chat_id: int, kwargs: dict):
+        bucket = self.chat_bucket(chat_id)
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await bucket.acquire()
+            while (pause := self.paused_until - time.monotonic()) > 0: await asyncio.sleep(pause)
+            await self.global_bucket.acquire()
+            try:
+                result = await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+                self.sent += 1; self.recent_sends.append(time.monotonic())
+                return result
+            except RetryAfter as e:
+                if attempt == SEND_MAX_RETRIES: raise
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                logger.warning(f"Flood control on {method} to {chat_id}, pausing sends for {retry_after}s.")
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after); self.retried += 1
+
+    def stats(self) -> dict:
+        window_start = time.monotonic() - 60
+        per_second = sum(1 for t in self.recent_sends if t >= window_start) / 60
+        return {'queued': self.queued, 'sent': self.sent, 'failed': self.failed, 'retried': self.retried, 'per_second': per_second}
+
+DISPATCHERS = {}
+
+def get_dispatcher(bot: Bot) -> MessageDispatcher:
+    dispatcher = DISPATCHERS.get(bot.token)
+    if dispatcher is None: dispatcher = DISPATCHERS[bot.token] = MessageDispatcher(bot)
+    return dispatcher
+
+def dispatcher_stats() -> dict:
+    totals = {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'per_second': 0.0}
+    for dispatcher in DISPATCHERS.values():
+        for key, value in dispatcher.stats().items(): totals[key] += value
+    return totals
+
+async def send_to_many(bot: Bot, chat_ids, text: str, description: str, **kwargs) -> int:
+    """Queues the same message for every chat and waits for all of them; returns how many succeeded."""
+    chat_ids = list(chat_ids)
+    dispatcher = get_dispatcher(bot)
+    results = await asyncio.gather(*(dispatcher.send('send_message', chat_id, text=text, **kwargs) for chat_id in chat_ids), return_exceptions=True)
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception): logger.error(f"Failed to send {description} to {chat_id}: {result}")
+    return sum(1 for result in results if not isinstance(result, Exception))
+
+# --- STOCK DIFF ENGINE ---
+# Each new snapshot is diffed once against the previous one into typed per-item events.
+# Alerts are built from these, and other consumers can register with add_stock_listener().
+class StockEvent(NamedTuple):
+    kind: str  # 'appeared', 'disappeared', 'quantity' or 'weather'
+    category: str | None = None
+    item_id: int | None = None
+    old_value: int | None = None
+    new_value: int | None = None
+
+    @property
+    def name(self) -> str: return ITEM_NAMES[self.item_id]
+
+    @property
+    def key(self) -> str: return ITEM_KEYS[self.item_id]
+
+STOCK_LISTENERS = []
+
+def add_stock_listener(callback):
+    """Registers callback(snapshot, events), called once for every newly published snapshot.
+
+    `events` is the diff from the previously published snapshot, or empty for the first one.
+    """
+    STOCK_LISTENERS.append(callback)
+
+def diff_snapshots(old_data: Snapshot, new_data: Snapshot) -> list[StockEvent]:
+    events = [StockEvent('weather')] if new_data.weather != old_data.weather else []
+    old_stock, new_stock = old_data.stock, new_data.stock
+    for category_name in [*new_stock, *(c for c in old_stock if c not in new_stock)]:
+        old_items, new_items = old_stock.get(category_name, ()), new_stock.get(category_name, ())
+        if old_items == new_items: continue
+        old_values, new_values = dict(old_items), dict(new_items)
+        for item_id, value in new_values.items():
+            if item_id not in old_values: events.append(StockEvent('appeared', category_name, item_id, None, value))
+            elif old_values[item_id] != value: events.append(StockEvent('quantity', category_name, item_id, old_values[item_id], value))
+        events.extend(StockEvent('disappeared', category_name, item_id, value, None) for item_id, value in old_values.items() if item_id not in new_values)
+    return events
+
+def is_prized(event: StockEvent) -> bool:
+    return event.kind == 'appeared' and event.key in PRIZED_ITEMS
+
+# --- STOCK HISTORY ---
+# Every published snapshot and its events are appended to a separate SQLite file. Item names get
+# stable ids there (the in-process ids from intern_item() change between runs), and events are
+# indexed by (item, kind, ts) so "last seen" and "how often" lookups are single index seeks.
+HISTORY_DB_FILE = "history.db"
+HISTORY_EVENT_KINDS = ('appeared', 'disappeared', 'quantity')
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (item_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, name_key TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_items_key ON items (name_key);
+CREATE TABLE IF NOT EXISTS snapshots (ts INTEGER PRIMARY KEY, digest TEXT, weather TEXT, stock TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS events (ts INTEGER NOT NULL, item INTEGER NOT NULL, category TEXT NOT NULL, kind INTEGER NOT NULL, value INTEGER);
+CREATE INDEX IF NOT EXISTS idx_events_item ON events (item, kind, ts);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+"""
+
+class StockHistory:
+    def __init__(self, filename: str):
+        self.filename, self.conn, self.lock = filename, None, Lock()
+        self.item_ids, self.pending, self.next_maintenance = {}, [], 0.0
+
+    def open(self):
+        self.conn = sqlite3.connect(get_data_filepath(self.filename), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(HISTORY_SCHEMA)
+            self.item_ids = {row['name']: row['item_id'] for row in self.conn.execute("SELECT item_id, name FROM items")}
+
+    def close(self):
+        if self.conn is not None:
+            with self.lock: self.conn.close()
+            self.conn = None
+
+    def take_pending(self) -> list:
+        batch, self.pending = self.pending, []
+        return batch
+
+    def history_id(self, name: str) -> int:
+        item_id = self.item_ids.get(name)
+        if item_id is None:
+            self.conn.execute("INSERT OR IGNORE INTO items (name, name_key) VALUES (?, ?)", (name, name.lower()))
+            item_id = self.item_ids[name] = self.conn.execute("SELECT item_id FROM items WHERE name = ?", (name,)).fetchone()['item_id']
+        return item_id
+
+    def record(self, batch):
+        """Appends (ts, snapshot, events) samples; runs in a worker thread."""
+        try:
+            with self.lock, self.conn:
+                for ts, snapshot, events in batch:
+                    stock = json.dumps([[cat, self.history_id(item.name), item.value] for cat, items in snapshot.stock.items() for item in items], separators=(',', ':'))
+                    self.conn.execute("INSERT OR REPLACE INTO snapshots (ts, digest, weather, stock) VALUES (?, ?, ?, ?)", (ts, snapshot.digest, json.dumps(list(snapshot.weather)), stock))
+                    self.conn.executemany("INSERT INTO events (ts, item, category, kind, value) VALUES (?, ?, ?, ?, ?)", [
+                        (ts, self.history_id(e.name), e.category, HISTORY_EVENT_KINDS.index(e.kind), e.old_value if e.kind == 'disappeared' else e.new_value) for e in events if e.kind != 'weather'])
+            if time.time() >= self.next_maintenance: self.maintain()
+        except sqlite3.Error as e:
+            self.item_ids = {}  # Ids handed out inside the rolled-back transaction are gone.
+            logger.error(f"Failed to record {len(batch)} stock history samples: {e}")
+
+    def maintain(self):
+        now = time.time(); self.next_maintenance = now + 3600
+        retention_cutoff, full_res_cutoff = int(now - HISTORY_RETENTION_DAYS * 86400), int(now - HISTORY_FULL_RES_DAYS * 86400)
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM events WHERE ts < ?", (retention_cutoff,))
+            self.conn.execute("DELETE FROM snapshots WHERE ts < ?", (retention_cutoff,))
+            self.conn.execute("DELETE FROM snapshots WHERE ts < ? AND ts NOT IN (SELECT MIN(ts) FROM snapshots WHERE ts < ? GROUP BY ts / ?)", (full_res_cutoff, full_res_cutoff, HISTORY_DOWNSAMPLE_SECONDS))
+
+    def find_item(self, query: str) -> tuple[int, str] | None:
+        """Resolves a user-typed name to (item_id, name): exact match first, then the shortest containing name."""
+        key = query.strip().lower()
+        with self.lock:
+            row = self.conn.execute("SELECT item_id, name FROM items WHERE name_key = ?", (key,)).fetchone()
+            if row is None: row = self.conn.execute("SELECT item_id, name FROM items WHERE name_key LIKE ? ORDER BY length(name) LIMIT 1", (f"%{key}%",)).fetchone()
+        return (row['item_id'], row['name']) if row else None
+
+    def last_seen(self, item_id: int):
+        with self.lock: return self.conn.execute("SELECT ts, category, value FROM events WHERE item = ? AND kind = 0 ORDER BY ts DESC LIMIT 1", (item_id,)).fetchone()
+
+    def appearances(self, item_id: int, since: int):
+        with self.lock: return self.conn.execute("SELECT COUNT(*) AS count, AVG(value) AS avg_value, MAX(value) AS max_value FROM events WHERE item = ? AND kind = 0 AND ts >= ?", (item_id, since)).fetchone()
+
+    def restock_counts(self, since: int) -> dict[str, int]:
+        with self.lock: return {row['category']: row['restocks'] for row in self.conn.execute("SELECT category, COUNT(DISTINCT ts) AS restocks FROM events WHERE ts >= ? AND kind = 0 GROUP BY category", (since,))}
+
+    def presence_counts(self, since: int) -> list:
+        """(category, name, quantity, samples) for every item in stock right after a recorded restock of its category."""
+        with self.lock: return self.conn.execute("""
+            WITH restocks AS (SELECT DISTINCT ts, category FROM events WHERE ts >= ? AND kind = 0)
+            SELECT r.category, i.name, json_extract(j.value, '$[2]') AS quantity, COUNT(*) AS samples
+            FROM restocks r JOIN snapshots s ON s.ts = r.ts, json_each(s.stock) j JOIN items i ON i.item_id = json_extract(j.value, '$[1]')
+            WHERE json_extract(j.value, '$[0]') = r.category GROUP BY r.category, i.name, quantity""", (since,)).fetchall()
+
+    def recent_appearances(self, limit: int) -> list:
+        with self.lock: return self.conn.execute("SELECT e.ts, i.name, e.category, e.value FROM events e JOIN items i ON i.item_id = e.item WHERE e.kind = 0 ORDER BY e.ts DESC LIMIT ?", (limit,)).fetchall()
+
+STOCK_HISTORY = StockHistory(HISTORY_DB_FILE)
+
+def record_history(snapshot: Snapshot, events: list[StockEvent]):
+    STOCK_HISTORY.pending.append((int(time.time()), snapshot, events))
+
+if BOT_SHARD_INDEX == 0: add_stock_listener(record_history)
+
+def format_ago(ts: int) -> str:
+    return format_timedelta(timedelta(seconds=time.time() - ts), short=True)
+
+# --- RESTOCK ODDS ---
+# Per category, how many restocks were seen, and per item how often (and at what quantity) it was
+# in stock right after one. Counts are rebuilt from history with one aggregate query every hour over
+# the last ODDS_WINDOW_DAYS and bumped incrementally for each new snapshot in between. Only snapshots
+# where items appeared in a category count as its restock; quantity ticks and sell-outs in between don't.
+RESTOCK_STATS_TASK = None
+
+class RestockStats:
+    def __init__(self):
+        self.restocks: Counter = Counter()
+        self.quantities: dict[tuple[str, str], Counter] = {}
+        self.names: dict[str, str] = {}
+
+    def rebuild(self, restocks: dict[str, int], presence: list):
+        quantities, names = {}, {}
+        for row in presence:
+            key = row['name'].lower(); names[key] = row['name']
+            quantities.setdefault((row['category'], key), Counter())[row['quantity']] += row['samples']
+        self.restocks, self.quantities, self.names = Counter(restocks), quantities, names
+
+    def observe(self, snapshot: Snapshot, events: list[StockEvent]):
+        for category_name in {e.category for e in events if e.kind == 'appeared'}:
+            self.restocks[category_name] += 1
+            for item in snapshot.stock.get(category_name, ()):
+                self.names[item.key] = item.name
+                self.quantities.setdefault((category_name, item.key), Counter())[item.value] += 1
+
+    def find(self, query: str) -> str | None:
+        key = query.strip().lower()
+        if key in self.names: return key
+        return min((k for k in self.names if key in k), key=len, default=None)
+
+    def odds(self, key: str) -> list[tuple[str, float, Counter]]:
+        """(category, chance per restock, quantity counts) for every category the item was seen in."""
+        return sorted(((cat, sum(counts.values()) / self.restocks[cat], counts) for (cat, k), counts in self.quantities.items() if k == key and self.restocks[cat]), key=lambda o: -o[1])
+
+    def prized_odds(self, categories) -> float:
+        """Chance that at least one prized item shows up when all of `categories` restock."""
+        miss = 1.0
+        for (cat, key), counts in self.quantities.items():
+            if cat in categories and key in PRIZED_ITEMS and self.restocks[cat]: miss *= 1 - min(sum(counts.values()) / self.restocks[cat], 1.0)
+        return 1 - miss
+
+RESTOCK_STATS = RestockStats()
+add_stock_listener(RESTOCK_STATS.observe)
+
+async def restock_stats_loop():
+    while True:
+        try:
+            since = int(time.time() - ODDS_WINDOW_DAYS * 86400)
+            restocks, presence = await asyncio.to_thread(lambda: (STOCK_HISTORY.restock_counts(since), STOCK_HISTORY.presence_counts(since)))
+            RESTOCK_STATS.rebuild(restocks, presence)
+            logger.info(f"Rebuilt restock odds from {sum(restocks.values())} recorded restocks.")
+        except Exception as e: logger.error(f"Failed to rebuild restock odds: {e}")
+        await asyncio.sleep(3600)
+
+def ensure_restock_stats():
+    global RESTOCK_STATS_TASK
+    if RESTOCK_STATS_TASK is None or RESTOCK_STATS_TASK.done(): RESTOCK_STATS_TASK = asyncio.create_task(restock_stats_loop())
+
+# --- SHARED STOCK FEED ---
+# One poller fetches the upstream APIs per interval and fans each snapshot out to every
+# subscribed tracker, whichever bot (main or child) it was started from.
+STOCK_FEED_TASK = None
+# The snapshot most recently fanned out. Trackers follow it unless LAST_SENT_DATA holds another baseline
+# for them; their rows say last_hash FOLLOWS_FEED, so neither is touched per tracker on each publish.
+PUBLISHED_SNAPSHOT, FOLLOWS_FEED = None, 'feed'
+# The latest background delivery per chat; the next one for that chat waits for it so alerts keep their order.
+DELIVERY_TASKS = {}
+
+class NotificationIndex:
+    """Inverted index from a lowercase item name to the trackers whose filters match it.
+
+    Substring matches are resolved once per (item name, filter) and kept up to date as trackers
+    subscribe or unsubscribe, so a stock change only touches the changed items and their subscribers.
+    Prized items interest every tracker and are looked up directly in PRIZED_ITEMS.
+    """
+    def __init__(self):
+        self.by_filter: dict[str, set[int]] = {}
+        self.unfiltered: set[int] = set()
+        self.name_matches: dict[str, frozenset[str]] = {}
+
+    def add(self, chat_id: int, filters: list[str]):
+        if not filters: self.unfiltered.add(chat_id); return
+        for f in filters:
+            if f not in self.by_filter:
+                self.by_filter[f] = set()
+                for name, matched in self.name_matches.items():
+                    if f in name: self.name_matches[name] = matched | {f}
+            self.by_filter[f].add(chat_id)
+
+    def remove(self, chat_id: int, filters: list[str]):
+        self.unfiltered.discard(chat_id)
+        for f in filters:
+            subscribers = self.by_filter.get(f)
+            if subscribers is None: continue
+            subscribers.discard(chat_id)
+            if subscribers: continue
+            del self.by_filter[f]
+            for name, matched in self.name_matches.items():
+                if f in matched: self.name_matches[name] = matched - {f}
+
+    def matching_filters(self, name: str) -> frozenset[str]:
+        matched = self.name_matches.get(name)
+        if matched is None: matched = self.name_matches[name] = frozenset(f for f in self.by_filter if f in name)
+        return matched
+
+    def subscribers_for(self, names) -> set[int]:
+        chats = set(self.unfiltered)
+        for name in names:
+            for f in self.matching_filters(name): chats |= self.by_filter[f]
+        return chats
+
+    def wants(self, filters: list[str], name: str) -> bool:
+        return not filters or not self.matching_filters(name).isdisjoint(filters)
+
+NOTIFY_INDEX = NotificationIndex()
+
+def persist_tracker(chat_id: int):
+    tracker_info = ACTIVE_TRACKERS.get(chat_id)
+    if tracker_info is None: return
+    baseline = LAST_SENT_DATA.get(chat_id, PUBLISHED_SNAPSHOT)
+    save_row('trackers', chat_id, {'bot_token': tracker_info['bot'].token, 'filters': tracker_info['filters'], 'is_muted': int(tracker_info.get('is_muted', False)), 'first_name': tracker_info.get('first_name'), 'version': tracker_info.get('version'), 'last_hash': FOLLOWS_FEED if chat_id not in LAST_SENT_DATA else baseline.digest if baseline else None})
+
+def start_tracking(chat_id: int, bot: Bot, filters: list[str], first_name: str, initial_data: Snapshot | None, is_muted: bool = False, version: str = BOT_VERSION):
+    if chat_id in ACTIVE_TRACKERS: stop_tracking(chat_id)
+    if initial_data is not PUBLISHED_SNAPSHOT: LAST_SENT_DATA[chat_id] = initial_data
+    ACTIVE_TRACKERS[chat_id] = {'bot': bot, 'filters': filters, 'is_muted': is_muted, 'first_name': first_name, 'version': version}
+    NOTIFY_INDEX.add(chat_id, filters)
+    persist_tracker(chat_id); publish_tracker(chat_id)
+    logger.info(f"Subscribed chat_id {chat_id} to the stock feed.")
+
+def stop_tracking(chat_id: int) -> bool:
+    LAST_SENT_DATA.pop(chat_id, None)
+    tracker_info = ACTIVE_TRACKERS.pop(chat_id, None)
+    if tracker_info is None: return False
+    NOTIFY_INDEX.remove(chat_id, tracker_info['filters'])
+    delete_row('trackers', chat_id); publish_tracker(chat_id)
+    logger.info(f"Unsubscribed chat_id {chat_id} from the stock feed.")
+    return True
+
+RESTORED_SNAPSHOT = None
+
+def load_restore_baseline() -> Snapshot | None:
+    """Loads the snapshot saved before the last shutdown and drops saved trackers whose bot no longer exists."""
+    global RESTORED_SNAPSHOT, PUBLISHED_SNAPSHOT
+    last_snapshot = STATE_STORE.get_setting('last_snapshot')
+    RESTORED_SNAPSHOT = PUBLISHED_SNAPSHOT = Snapshot.from_dict(last_snapshot) if last_snapshot else None
+    if BOT_SHARD_INDEX == 0:
+        for chat_id, row in STATE_STORE.load('trackers').items():
+            if row['bot_token'] != TOKEN and row['bot_token'] not in CHILD_BOTS: delete_row('trackers', chat_id)
+    return RESTORED_SNAPSHOT
+
+def restore_trackers(bot: Bot):
+    """Re-subscribes the trackers saved for this bot before the last shutdown.
+
+    A tracker that followed the feed, or whose saved hash matches RESTORED_SNAPSHOT, diffs against it as
+    usual; any other tracker silently adopts the next snapshot, so nobody gets a fresh full report after a restart.
+    """
+    restored = 0
+    for chat_id, row in STATE_STORE.load('trackers', bot_token=bot.token).items():
+        if chat_id in ACTIVE_TRACKERS: continue
+        if not is_vip(chat_id) or chat_id in BANNED_USERS: delete_row('trackers', chat_id); continue
+        baseline = RESTORED_SNAPSHOT if RESTORED_SNAPSHOT and row['last_hash'] in (FOLLOWS_FEED, RESTORED_SNAPSHOT.digest) else None
+        start_tracking(chat_id, bot, row['filters'] or [], row['first_name'], baseline, is_muted=bool(row['is_muted']), version=row['version'] or '0.0.0')
+        restored += 1
+    if restored: logger.info(f"Restored {restored} tracker subscription(s) for @{bot.username}.")
+
+async def deliver_alerts(chat_id: int, tracker_info: dict, new_data: Snapshot, events: list[StockEvent]):
+    """Sends one tracker the alerts for the events routed to it by publish_snapshot."""
+    bot = tracker_info['bot']
+    dispatcher = get_dispatcher(bot)
+    prized = [e for e in events if is_prized(e)]
+    by_category = {}
+    for e in events:
+        if e.kind != 'weather' and not is_prized(e): by_category.setdefault(e.category, []).append(e)
+
+    if any(e.kind == 'weather' for e in events):
+        weather_alert = render_cached(new_data, ('weather_alert',), lambda: f"🌦️ <b>The weather has changed!</b>\n\n{render_weather(new_data)}")
+        try: await dispatcher.send('send_message', chat_id, text=weather_alert, parse_mode=ParseMode.HTML)
+        except Exception as e: logger.error(f"Failed weather alert to {chat_id}: {e}")
+
+    if prized:
+        alert_message = render_cached(new_data, ('prized', tuple(prized)), lambda: "🚨 <b>PRIZED ITEM ALERT!</b> 🚨\n\n" + "\n".join([f"› {add_emoji(e.name)}: {format_value(e.new_value)}" for e in prized]))
+        try: await dispatcher.send('send_message', chat_id, text=alert_message, parse_mode=ParseMode.HTML); await send_music_vm(bot, chat_id)
+        except Exception as e: logger.error(f"Failed prized alert to {chat_id}: {e}")
+
+    for category_name, category_events in by_category.items():
+        alert_message = render_cached(new_data, ('changes', category_name, tuple(category_events)), lambda: format_change_message(category_name, category_events))
+        alert_message += format_restock_footer(restock_countdown(category_name))
+        try: await dispatcher.send('send_message', chat_id, text=alert_message, parse_mode=ParseMode.HTML)
+        except Exception as e: logger.error(f"Failed category alert to {chat_id}: {e}")
+
+def route_events(events: list[StockEvent]) -> dict[int, list[StockEvent]]:
+    """Works out which unmuted trackers on the feed get which events.
+
+    Weather and prized events go to everyone; item events only reach the trackers the
+    NotificationIndex matches to that item name.
+    """
+    def wants(chat_id):
+        tracker_info = ACTIVE_TRACKERS.get(chat_id)
+        return tracker_info is not None and not tracker_info.get('is_muted', True) and chat_id not in LAST_SENT_DATA
+    broadcast = [e for e in events if e.kind == 'weather' or is_prized(e)]
+    recipients = {chat_id: list(broadcast) for chat_id in ACTIVE_TRACKERS if wants(chat_id)} if broadcast else {}
+    for e in events:
+        if e.kind == 'weather' or is_prized(e): continue
+        for chat_id in NOTIFY_INDEX.subscribers_for([e.key]):
+            if chat_id in recipients or wants(chat_id): recipients.setdefault(chat_id, []).append(e)
+    return recipients
+
+def publish_snapshot(previous: Snapshot | None, new_data: Snapshot, events: list[StockEvent] | None):
+    """Fans a new snapshot out to the trackers it concerns; the sends run as background tasks.
+
+    `events` is the diff from `previous` (the last published snapshot) to `new_data`. Trackers on the
+    feed share it: only those route_events picks are visited, and moving PUBLISHED_SNAPSHOT advances
+    the rest. Trackers in LAST_SENT_DATA have another baseline (e.g. restored without a match), so each
+    is diffed on its own once and then joins the feed.
+    """
+    global PUBLISHED_SNAPSHOT
+    for callback in STOCK_LISTENERS:
+        try: callback(new_data, events or [])
+        except Exception as e: logger.error(f"Stock listener {getattr(callback, '__name__', callback)} failed: {e}")
+    recipients = route_events(events) if events else {}
+    deliveries = [(chat_id, deliver_alerts(chat_id, ACTIVE_TRACKERS[chat_id], new_data, chat_events)) for chat_id, chat_events in recipients.items()]
+
+    PUBLISHED_SNAPSHOT = new_data
+    for chat_id, baseline in list(LAST_SENT_DATA.items()):
+        del LAST_SENT_DATA[chat_id]
+        tracker_info = ACTIVE_TRACKERS.get(chat_id)
+        if tracker_info is None: continue
+        # No baseline means restored without a match: adopt this snapshot silently.
+        if baseline is not None and baseline is not new_data and not tracker_info.get('is_muted', True):
+            filters = tracker_info['filters']
+            own_events = [e for e in diff_snapshots(baseline, new_data) if e.kind == 'weather' or is_prized(e) or NOTIFY_INDEX.wants(filters, e.key)]
+            if own_events: deliveries.append((chat_id, deliver_alerts(chat_id, tracker_info, new_data, own_events)))
+        persist_tracker(chat_id)
+
+    for chat_id, coro in deliveries:
+        task = DELIVERY_TASKS[chat_id] = asyncio.create_task(deliver_in_order(chat_id, DELIVERY_TASKS.get(chat_id), coro))
+        task.add_done_callback(lambda t, chat_id=chat_id: DELIVERY_TASKS.get(chat_id) is t and DELIVERY_TASKS.pop(chat_id))
+
+async def deliver_in_order(chat_id: int, previous: asyncio.Task | None, coro):
+    if previous is not None: await asyncio.wait([previous])
+    try: await coro
+    except Exception as e: logger.error(f"Failed to deliver stock update to {chat_id}: {e}")
+
+class RestockPollScheduler:
+    """Decides how long the feed sleeps, based on the boundaries from calculate_next_restock_times().
+
+    Bursts at boundaries where RESTOCK_STATS gives a prized item a real chance poll at PRIZED_POLL_SECONDS.
+    """
+    def __init__(self):
+        self.burst_until, self.burst_interval, self.burst_categories = None, RESTOCK_POLL_SECONDS, set()
+        self.advance()
+
+    def advance(self):
+        times = calculate_next_restock_times()
+        self.next_boundary = min(times.values())
+        self.restocking = [cat for cat, t in times.items() if t == self.next_boundary]
+
+    def next_delay(self) -> float:
+        now = get_ph_time()
+        if self.burst_until and now < self.burst_until: return self.burst_interval
+        self.burst_until = None
+        until_boundary = (self.next_boundary - now).total_seconds() + RESTOCK_GRACE_SECONDS
+        return max(min(until_boundary, IDLE_POLL_SECONDS), 1.0)
+
+    def observe(self, appeared_categories: set[str]):
+        """`appeared_categories` are the categories with an 'appeared' event in the latest poll."""
+        now = get_ph_time()
+        if now >= self.next_boundary:
+            self.burst_until = self.next_boundary + timedelta(seconds=RESTOCK_WINDOW_SECONDS)
+            self.burst_interval = PRIZED_POLL_SECONDS if RESTOCK_STATS.prized_odds(self.restocking) >= PRIZED_ODDS_THRESHOLD else RESTOCK_POLL_SECONDS
+            self.burst_categories = set(self.restocking)
+            self.advance()
+        # Once every restocking category has landed there is nothing left to wait for until the next boundary;
+        # a category that restocks without new items keeps the burst up until RESTOCK_WINDOW_SECONDS runs out.
+        if self.burst_until and self.burst_categories:
+            self.burst_categories -= appeared_categories
+            if not self.burst_categories: self.burst_until = None
+
+async def stock_feed_loop(last_published: Snapshot | None = None):
+    logger.info("Shared stock feed started.")
+    scheduler = RestockPollScheduler()
+    while True:
+        # Polls even with no trackers: history and restock odds are recorded from every snapshot.
+        await asyncio.sleep(scheduler.next_delay())
+        new_data = await fetch_all_data()
+        # An unchanged upstream hands back the already-published snapshot, so skip the parse-and-diff fan-out.
+        if not new_data or new_data is last_published: scheduler.observe(set()); continue
+        events = diff_snapshots(last_published, new_data) if last_published is not None else None
+        scheduler.observe({e.category for e in events or () if e.kind == 'appeared'})
+        publish_snapshot(last_published, new_data, events)
+        last_published = new_data
+
+async def shard_feed_loop(last_published: Snapshot | None = None):
+    logger.info(f"Shard {BOT_SHARD_INDEX} is following the stock feed of shard 0.")
+    while True:
+        await asyncio.sleep(SHARD_FEED_POLL_SECONDS)
+        new_data = await fetch_all_data()
+        if not new_data or new_data is last_published or (last_published and new_data.digest == last_published.digest): continue
+        events = diff_snapshots(last_published, new_data) if last_published is not None else None
+        publish_snapshot(last_published, new_data, events)
+        last_published = new_data
+
+def ensure_stock_feed(last_published: Snapshot | None = None):
+    global STOCK_FEED_TASK
+    feed = stock_feed_loop if BOT_SHARD_INDEX == 0 else shard_feed_loop
+    if STOCK_FEED_TASK is None or STOCK_FEED_TASK.done(): STOCK_FEED_TASK = asyncio.create_task(feed(last_published))
+
+# --- DASHBOARD STREAM ---
+# The dashboard page is static: it loads the current state once from /api/state and then applies
+# activity, tracker and stock events pushed over /api/stream (Server-Sent Events).
+DASHBOARD_STREAM_BUFFER, DASHBOARD_KEEPALIVE_SECONDS = 256, 15
+DEFAULT_AVATAR_URL = "https://i.imgur.com/jpfrJd3.png"
+
+class DashboardHub:
+    def __init__(self):
+        self.queues: set[asyncio.Queue] = set()
+        self.recent_stock = deque(maxlen=30)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=DASHBOARD_STREAM_BUFFER); self.queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.queues.discard(queue)
+
+    def publish(self, kind: str, data):
+        if not self.queues: return
+        message = f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode()
+        for queue in list(self.queues):
+            try: queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A viewer that can't keep up is cut off; its page reloads the state and reconnects.
+                self.queues.discard(queue)
+                while not queue.empty(): queue.get_nowait()
+                queue.put_nowait(None)
+
+DASHBOARD_HUB = DashboardHub()
+
+def tracker_view(user_id: int) -> dict | None:
+    user_info, tracker_info = USER_INFO_CACHE.get(str(user_id)), ACTIVE_TRACKERS.get(user_id)
+    if not user_info or tracker_info is None: return None
+    avatar_url = f"https://api.telegram.org/file/bot{TOKEN}/{user_info['avatar_path']}" if user_info.get('avatar_path') else DEFAULT_AVATAR_URL
+    return {'user_id': user_id, 'first_name': user_info.get('first_name'), 'username': user_info.get('username'), 'avatar_url': avatar_url, 'is_muted': tracker_info.get('is_muted', False), 'active': True}
+
+def publish_tracker(user_id: int):
+    DASHBOARD_HUB.publish('tracker', tracker_view(user_id) or {'user_id': user_id, 'active': False})
+
+def publish_stock(snapshot: Snapshot, events: list[StockEvent]):
+    timestamp = datetime.now(pytz.utc).isoformat(); views = []
+    for e in events:
+        if e.kind == 'weather': views.append({'item': "🌦️ Weather", 'change': f"{snapshot.weather.icon} {snapshot.weather.name}", 'timestamp': timestamp})
+        else: views.append({'item': f"{add_emoji(e.name)} ({e.category})", 'change': {'appeared': f"🆕 {format_value(e.new_value)}", 'disappeared': "❌ sold out"}.get(e.kind) or f"🔁 {format_value(e.old_value)} → {format_value(e.new_value)}", 'timestamp': timestamp})
+    if not views: return
+    DASHBOARD_HUB.recent_stock.extendleft(views)
+    DASHBOARD_HUB.publish('stock', views)
+
+add_stock_listener(publish_stock)
+
+def dashboard_state() -> dict:
+    # Built without awaiting, so the trackers, activity and stock feed all describe the same moment.
+    return {'stats': {"active_trackers": len(ACTIVE_TRACKERS), "authorized_users": len(AUTHORIZED_USERS), "admins": len(ADMIN_USERS)},
+            'active_users': [view for view in map(tracker_view, ACTIVE_TRACKERS) if view],
+            'activity': list(USER_ACTIVITY), 'stock_events': list(DASHBOARD_HUB.recent_stock)}
 
 # --- AESTHETIC HTML TEMPLATES ---
-DASHBOARD_HTML = """<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>Bot Dashboard</title><script src="https://cdn.jsdelivr.net/npm/tsparticles-slim@2.12.0/tsparticles.slim.bundle.min.js"></script><style>:root{--bg:#0d1117;--primary:#c9a4ff;--secondary:#58a6ff;--surface:#161b22;--on-surface:#e6edf3;--border:#3036d;--red:#f85149;}body{font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,sans-serif;background-color:var(--bg);color:var(--on-surface);margin:0;padding:1.5rem;overflow-x:hidden;}#tsparticles{position:fixed;top:0;left:0;width:100%;height:100%;z-index:-1;}.container{max-width:1200px;margin:auto;animation:fadeIn 0.8s ease-out;}.header{display:flex;flex-wrap:wrap;justify-content:space-between;align-items:center;border-bottom:1px solid var(--border);padding-bottom:1rem;margin-bottom:2rem;}h1, h2{font-weight:600;color:white;letter-spacing:-1px;}h1{margin:0;font-size:1.8rem;} h2{border-bottom:1px solid var(--border);padding-bottom:10px;margin:2.5rem 0 1.5rem 0;}h2 i{margin-right:0.5rem;color:var(--primary);}.logout-btn{color:var(--red);text-decoration:none;background-color:rgba(248,81,73,0.1);padding:10px 15px;border-radius:6px;border:1px solid var(--red);font-weight:500;transition:all 0.2s;}.logout-btn:hover{background-color:rgba(248,81,73,0.2);transform:translateY(-2px);}.stats-grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(250px,1fr));gap:1.5rem;margin-bottom:2.5rem;}.stat-card{background:linear-gradient(145deg,rgba(255,255,255,0.05),rgba(255,255,255,0));backdrop-filter:blur(10px);-webkit-backdrop-filter:blur(10px);padding:1.5rem;border-radius:12px;border:1px solid var(--border);display:flex;align-items:center;gap:1.5rem;transition:all 0.3s ease;}.stat-card:hover{transform:translateY(-5px);box-shadow:0 10px 20px rgba(0,0,0,0.2);}.stat-card .icon{font-size:1.8rem;color:var(--primary);background:linear-gradient(145deg,rgba(201,164,255,0.1),rgba(201,164,255,0.2));width:60px;height:60px;border-radius:50%;display:grid;place-items:center;}.stat-card .value{font-size:2.8rem;font-weight:700;color:white;} .stat-card .label{font-size:1rem;color:#8b949e;}.user-grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(300px,1fr));gap:1.5rem;}.user-card{background-color:var(--surface);border-radius:12px;border:1px solid var(--border);padding:1.5rem;display:flex;align-items:center;gap:1rem;transition:all 0.3s ease;}.user-card:hover{transform:translateY(-5px);box-shadow:0 10px 20px rgba(0,0,0,0.2);}.user-card img{width:50px;height:50px;border-radius:50%;border:2px solid var(--border);}.user-card .name{font-weight:600;color:white;} .user-card .username{color:#8b949e;font-size:0.9em;}.user-card .status{margin-left:auto;padding:5px 10px;border-radius:20px;font-size:0.8rem;font-weight:600;}.status.muted{background-color:rgba(248,81,73,0.1);color:var(--red);} .status.active{background-color:rgba(46,160,67,0.15);color:#3fb950;}.activity-log{background-color:var(--surface);border-radius:12px;border:1px solid var(--border);overflow:hidden;box-shadow:0 5px 15px rgba(0,0,0,0.1);}table{width:100%;border-collapse:collapse;}th,td{text-align:left;padding:16px 20px;}th{background-color:rgba(187,134,252,0.05);color:var(--primary);font-weight:600;text-transform:uppercase;font-size:0.8rem;letter-spacing:0.5px;}tbody tr{border-bottom:1px solid var(--border);transition:background-color 0.2s;}tbody tr:last-child{border-bottom:none;}tbody tr:hover{background-color:rgba(88,166,255,0.08);}.user-cell{display:flex;align-items:center;gap:15px;}.user-cell img{width:45px;height:45px;border-radius:50%;border:2px solid var(--border);}.user-cell .name{font-weight:600;color:white;}.user-cell .username{color:#8b949e;font-size:0.9em;}code{background-color:#2b2b2b;color:var(--secondary);padding:4px 8px;border-radius:4px;font-family:"SF Mono","Fira Code",monospace;}@keyframes fadeIn{from{opacity:0;transform:translateY(20px);}to{opacity:1;transform:translateY(0);}}@media(max-width:768px){body{padding:1rem;}.header,h1{flex-direction:column;gap:1rem;text-align:center;}.stats-grid,.user-grid{grid-template-columns:1fr;}h1{font-size:1.5rem;}.stat-card .value{font-size:2.2rem;}}</style><link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css"></head><body><div id="tsparticles"></div><div class="container"><div class="header"><h1><i class="fa-solid fa-shield-halved"></i> GAG Bot Dashboard</h1><a href="/logout" class="logout-btn"><i class="fa-solid fa-arrow-right-from-bracket"></i> Logout</a></div><div class="stats-grid"><div class="stat-card"><div class="icon"><i class="fa-solid fa-users"></i></div><div><div class="value" data-target="{{ stats.authorized_users }}">0</div><div class="label">Total Authorized Users</div></div></div><div class="stat-card"><div class="icon"><i class="fa-solid fa-user-shield"></i></div><div><div class="value" data-target="{{ stats.admins }}">0</div><div class="label">Admins</div></div></div></div><h2><i class="fa-solid fa-satellite-dish"></i> Active Trackers ({{ stats.active_trackers }})</h2><div class="user-grid">{% for user in active_users %}<div class="user-card"><img src="{{ user.avatar_url }}" alt="Avatar"><div><div class="name">{{ user.first_name }}</div><div class="username">@{{ user.username }}</div></div><div class="status {{ 'muted' if user.is_muted else 'active' }}">{{ 'MUTED' if user.is_muted else 'ACTIVE' }}</div></div>{% else %} <p>No users are currently tracking.</p> {% endfor %}</div><h2><i class="fa-solid fa-chart-line"></i> Recent Activity</h2><div class="activity-log"><table><thead><tr><th>User</th><th>Command</th><th>Time</th></tr></thead><tbody>{% for log in activity %}<tr><td><div class="user-cell"><img src="{{ log.avatar_url }}" alt="Avatar"><div><div class="name">{{ log.first_name }}</div><div class="username">@{{ log.username }}</div></div></div></td><td><code>{{ log.command }}</code></td><td>{{ log.time_ago }} ago</td></tr>{% endfor %}</tbody></table></div></div><script>document.addEventListener("DOMContentLoaded",function(){tsParticles.load("tsparticles",{preset:"stars",background:{color:{value:"#0d1117"}},particles:{color:{value:"#ffffff"},links:{color:"#ffffff",distance:150,enable:!0,opacity:.1,width:1},move:{enable:!0,speed:.5},number:{density:{enable:!0,area:800},value:40}}});document.querySelectorAll(".value").forEach(e=>{const t=+e.getAttribute("data-target"),o=()=>{const a=+e.innerText;if(a<t){e.innerText=`${Math.ceil(a+t/100)}`;setTimeout(o,20)}else{e.innerText=t}};o()})});</script></body></html>"""
+DASHBOARD_HTML = """<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><title>Bot Dashboard</title><script src="https://cdn.jsdelivr.net/npm/tsparticles-slim@2.12.0/tsparticles.slim.bundle.min.js"></script><style>:root{--bg:#0d1117;--primary:#c9a4ff;--secondary:#58a6ff;--surface:#161b22;--on-surface:#e6edf3;--border:#3036d;--red:#f85149;}body{font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,sans-serif;background-color:var(--bg);color:var(--on-surface);margin:0;padding:1.5rem;overflow-x:hidden;}#tsparticles{position:fixed;top:0;left:0;width:100%;height:100%;z-index:-1;}.container{max-width:1200px;margin:auto;animation:fadeIn 0.8s ease-out;}.header{display:flex;flex-wrap:wrap;justify-content:space-between;align-items:center;border-bottom:1px solid var(--border);padding-bottom:1rem;margin-bottom:2rem;}h1, h2{font-weight:600;color:white;letter-spacing:-1px;}h1{margin:0;font-size:1.8rem;} h2{border-bottom:1px solid var(--border);padding-bottom:10px;margin:2.5rem 0 1.5rem 0;}h2 i{margin-right:0.5rem;color:var(--primary);}.logout-btn{color:var(--red);text-decoration:none;background-color:rgba(248,81,73,0.1);padding:10px 15px;border-radius:6px;border:1px solid var(--red);font-weight:500;transition:all 0.2s;}.logout-btn:hover{background-color:rgba(248,81,73,0.2);transform:translateY(-2px);}.stats-grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(250px,1fr));gap:1.5rem;margin-bottom:2.5rem;}.stat-card{background:linear-gradient(145deg,rgba(255,255,255,0.05),rgba(255,255,255,0));backdrop-filter:blur(10px);-webkit-backdrop-filter:blur(10px);padding:1.5rem;border-radius:12px;border:1px solid var(--border);display:flex;align-items:center;gap:1.5rem;transition:all 0.3s ease;}.stat-card:hover{transform:translateY(-5px);box-shadow:0 10px 20px rgba(0,0,0,0.2);}.stat-card .icon{font-size:1.8rem;color:var(--primary);background:linear-gradient(145deg,rgba(201,164,255,0.1),rgba(201,164,255,0.2));width:60px;height:60px;border-radius:50%;display:grid;place-items:center;}.stat-card .value{font-size:2.8rem;font-weight:700;color:white;} .stat-card .label{font-size:1rem;color:#8b949e;}.user-grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(300px,1fr));gap:1.5rem;}.user-card{background-color:var(--surface);border-radius:12px;border:1px solid var(--border);padding:1.5rem;display:flex;align-items:center;gap:1rem;transition:all 0.3s ease;}.user-card:hover{transform:translateY(-5px);box-shadow:0 10px 20px rgba(0,0,0,0.2);}.user-card img{width:50px;height:50px;border-radius:50%;border:2px solid var(--border);}.user-card .name{font-weight:600;color:white;} .user-card .username{color:#8b949e;font-size:0.9em;}.user-card .status{margin-left:auto;padding:5px 10px;border-radius:20px;font-size:0.8rem;font-weight:600;}.status.muted{background-color:rgba(248,81,73,0.1);color:var(--red);} .status.active{background-color:rgba(46,160,67,0.15);color:#3fb950;}.activity-log{background-color:var(--surface);border-radius:12px;border:1px solid var(--border);overflow:hidden;box-shadow:0 5px 15px rgba(0,0,0,0.1);}table{width:100%;border-collapse:collapse;}th,td{text-align:left;padding:16px 20px;}th{background-color:rgba(187,134,252,0.05);color:var(--primary);font-weight:600;text-transform:uppercase;font-size:0.8rem;letter-spacing:0.5px;}tbody tr{border-bottom:1px solid var(--border);transition:background-color 0.2s;}tbody tr:last-child{border-bottom:none;}tbody tr:hover{background-color:rgba(88,166,255,0.08);}.user-cell{display:flex;align-items:center;gap:15px;}.user-cell img{width:45px;height:45px;border-radius:50%;border:2px solid var(--border);}.user-cell .name{font-weight:600;color:white;}.user-cell .username{color:#8b949e;font-size:0.9em;}code{background-color:#2b2b2b;color:var(--secondary);padding:4px 8px;border-radius:4px;font-family:"SF Mono","Fira Code",monospace;}@keyframes fadeIn{from{opacity:0;transform:translateY(20px);}to{opacity:1;transform:translateY(0);}}@media(max-width:768px){body{padding:1rem;}.header,h1{flex-direction:column;gap:1rem;text-align:center;}.stats-grid,.user-grid{grid-template-columns:1fr;}h1{font-size:1.5rem;}.stat-card .value{font-size:2.2rem;}}</style><link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css"></head><body><div id="tsparticles"></div><div class="container"><div class="header"><h1><i class="fa-solid fa-shield-halved"></i> GAG Bot Dashboard</h1><a href="/logout" class="logout-btn"><i class="fa-solid fa-arrow-right-from-bracket"></i> Logout</a></div><div class="stats-grid"><div class="stat-card"><div class="icon"><i class="fa-solid fa-users"></i></div><div><div class="value" id="stat-authorized">0</div><div class="label">Total Authorized Users</div></div></div><div class="stat-card"><div class="icon"><i class="fa-solid fa-user-shield"></i></div><div><div class="value" id="stat-admins">0</div><div class="label">Admins</div></div></div></div><h2><i class="fa-solid fa-satellite-dish"></i> Active Trackers (<span id="stat-trackers">0</span>)</h2><div class="user-grid" id="trackers"></div><h2><i class="fa-solid fa-seedling"></i> Live Stock Feed</h2><div class="activity-log"><table><thead><tr><th>Item</th><th>Change</th><th>Time</th></tr></thead><tbody id="stock"></tbody></table></div><h2><i class="fa-solid fa-chart-line"></i> Recent Activity</h2><div class="activity-log"><table><thead><tr><th>User</th><th>Command</th><th>Time</th></tr></thead><tbody id="activity"></tbody></table></div></div><script>const el=(tag,cls,text)=>{const e=document.createElement(tag);if(cls)e.className=cls;if(text!==undefined)e.textContent=text;return e};const ago=ts=>{let s=Math.max(0,Math.floor((Date.now()-Date.parse(ts))/1000));const d=Math.floor(s/86400);s%=86400;const h=Math.floor(s/3600);s%=3600;const m=Math.floor(s/60);s%=60;return[d&&d+"d",h&&h+"h",m&&m+"m",s+"s"].filter(Boolean).join(" ")};const timeCell=ts=>{const t=el("td","ago",ago(ts)+" ago");t.dataset.ts=ts;return t};const person=(u,cls)=>{const w=el("div",cls);const img=el("img");img.src=u.avatar_url;img.alt="Avatar";const t=el("div");t.append(el("div","name",u.first_name),el("div","username","@"+u.username));w.append(img,t);return w};const trackers=new Map();function renderTrackers(){const g=document.getElementById("trackers");g.replaceChildren();document.getElementById("stat-trackers").textContent=trackers.size;if(!trackers.size){g.append(el("p",null,"No users are currently tracking."));return}for(const u of trackers.values()){const c=person(u,"user-card");c.append(el("div","status "+(u.is_muted?"muted":"active"),u.is_muted?"MUTED":"ACTIVE"));g.append(c)}}function addRow(id,cells,ts,top,limit){const tr=el("tr");tr.append(...cells,timeCell(ts));const b=document.getElementById(id);top?b.prepend(tr):b.append(tr);while(b.children.length>limit)b.lastChild.remove()}function addActivity(a,top){const u=el("td");u.append(person(a,"user-cell"));const c=el("td");c.append(el("code",null,a.command));addRow("activity",[u,c],a.timestamp,top,50)}function addStock(e,top){addRow("stock",[el("td",null,e.item),el("td",null,e.change)],e.timestamp,top,30)}async function load(){const r=await fetch("/api/state");if(r.status==401){location="/login";return}const s=await r.json();document.getElementById("stat-authorized").textContent=s.stats.authorized_users;document.getElementById("stat-admins").textContent=s.stats.admins;trackers.clear();s.active_users.forEach(u=>trackers.set(u.user_id,u));renderTrackers();document.getElementById("activity").replaceChildren();s.activity.forEach(a=>addActivity(a,false));document.getElementById("stock").replaceChildren();s.stock_events.forEach(e=>addStock(e,false))}function connect(){const src=new EventSource("/api/stream");src.addEventListener("activity",m=>addActivity(JSON.parse(m.data),true));src.addEventListener("tracker",m=>{const d=JSON.parse(m.data);d.active?trackers.set(d.user_id,d):trackers.delete(d.user_id);renderTrackers()});src.addEventListener("stock",m=>JSON.parse(m.data).forEach(e=>addStock(e,true)));src.onerror=()=>{src.close();setTimeout(()=>load().then(connect),3000)}}setInterval(()=>document.querySelectorAll(".ago").forEach(t=>t.textContent=ago(t.dataset.ts)+" ago"),10000);document.addEventListener("DOMContentLoaded",function(){tsParticles.load("tsparticles",{preset:"stars",background:{color:{value:"#0d1117"}},particles:{color:{value:"#ffffff"},links:{color:"#ffffff",distance:150,enable:!0,opacity:.1,width:1},move:{enable:!0,speed:.5},number:{density:{enable:!0,area:800},value:40}}});load().then(connect)});</script></body></html>"""
 LOGIN_HTML = """<!DOCTYPE html><html><head><title>Admin Login</title><style>:root{--bg:#0d1117;--primary:#c9a4ff;--surface:#161b22;--border:#21262d;--red:#f85149;}body{display:flex;justify-content:center;align-items:center;height:100vh;background-color:var(--bg);color:white;font-family:-apple-system,sans-serif;}.login-box{background-color:var(--surface);padding:40px;border-radius:12px;border:1px solid var(--border);text-align:center;width:340px;box-shadow:0 10px 30px rgba(0,0,0,0.2);animation:fadeIn 0.5s ease-out;}h2{color:var(--primary);margin-top:0;margin-bottom:25px;font-weight:600;letter-spacing:-0.5px;}input{width:100%;box-sizing:border-box;padding:14px;margin-bottom:15px;border-radius:8px;border:1px solid var(--border);background:var(--bg);color:white;font-size:1rem;transition:border-color 0.2s;}input:focus{border-color:var(--primary);outline:none;}button{width:100%;padding:14px;background:linear-gradient(90deg,var(--primary),#9a66e2);color:black;border:none;border-radius:8px;cursor:pointer;font-weight:bold;font-size:1rem;transition:all 0.2s;}button:hover{transform:translateY(-2px);box-shadow:0 4px 15px rgba(201,164,255,0.2);}.error{color:var(--red);background-color:rgba(248,81,73,0.1);padding:10px;border-radius:6px;margin-top:15px;border:1px solid var(--red);}@keyframes fadeIn{from{opacity:0;transform:scale(0.95);}to{opacity:1;transform:scale(1);}}</style></head><body><div class="login-box"><form method="post"><h2>Bot Dashboard Login</h2><input type="text" name="username" placeholder="Username" required><input type="password" name="password" placeholder="Password" required><button type="submit">Login</button>{% if error %}<p class="error">{{ error }}</p>{% endif %}</form></div></body></html>"""
 
 # --- FLASK WEB ROUTES ---
 @app.route('/')
-def home_route(): return "Bot is alive. Admin dashboard is at /login."
+async def home_route(): return "Bot is alive. Admin dashboard is at /login."
 @app.route('/login', methods=['GET', 'POST'])
-def login_route():
+async def login_route():
     error = None
     if request.method == 'POST':
-        if request.form['username'] == ADMIN_USER and request.form['password'] == ADMIN_PASS: session['logged_in'] = True; return redirect(url_for('dashboard_route'))
+        form = await request.form
+        if form.get('username') == ADMIN_USER and form.get('password') == ADMIN_PASS: session['logged_in'] = True; return redirect(url_for('dashboard_route'))
         else: error = 'Invalid Credentials.'
-    return render_template_string(LOGIN_HTML, error=error)
+    return await render_template_string(LOGIN_HTML, error=error)
 @app.route('/dashboard')
-def dashboard_route():
+async def dashboard_route():
     if not session.get('logged_in'): return redirect(url_for('login_route'))
-    display_activity, active_users = [], []
-    for user_id, tracker_data in ACTIVE_TRACKERS.items():
-        user_info = USER_INFO_CACHE.get(str(user_id))
-        if user_info:
-            avatar_url = "https://i.imgur.com/jpfrJd3.png" 
-            if user_info.get('avatar_path'):
-                avatar_url = f"https://api.telegram.org/file/bot{TOKEN}/{user_info['avatar_path']}"
-            active_users.append({'first_name': user_info['first_name'], 'username': user_info['username'], 'avatar_url': avatar_url, 'is_muted': tracker_data['is_muted']})
-    for log in USER_ACTIVITY:
-        time_diff = datetime.now(pytz.utc) - datetime.fromisoformat(log['timestamp'])
-        display_activity.append({**log, "time_ago": format_timedelta(time_diff)})
-    stats = {"active_trackers": len(ACTIVE_TRACKERS), "authorized_users": len(AUTHORIZED_USERS), "admins": len(ADMIN_USERS)}
-    return render_template_string(DASHBOARD_HTML, activity=display_activity, stats=stats, active_users=active_users)
+    return DASHBOARD_HTML
+@app.route('/api/state')
+async def dashboard_state_route():
+    if not session.get('logged_in'): return {"error": "unauthorized"}, 401
+    return dashboard_state()
+@app.route('/api/stream')
+async def dashboard_stream_route():
+    if not session.get('logged_in'): return {"error": "unauthorized"}, 401
+    queue = DASHBOARD_HUB.subscribe()
+    async def stream():
+        try:
+            yield b": connected\n\n"
+            while True:
+                try: message = await asyncio.wait_for(queue.get(), DASHBOARD_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError: yield b": keepalive\n\n"; continue
+                if message is None: return
+                yield message
+        finally: DASHBOARD_HUB.unsubscribe(queue)
+    response = await make_response(stream(), {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None
+    return response
 @app.route('/logout')
-def logout_route(): session.pop('logged_in', None); return redirect(url_for('login_route'))
+async def logout_route(): session.pop('logged_in', None); return redirect(url_for('login_route'))
+@app.route('/telegram/<route_id>', methods=['POST'])
+async def telegram_webhook_route(route_id):
+    bot_app = WEBHOOK_ROUTES.get(route_id)
+    if bot_app is None: return "", 404
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET: return "", 403
+    await bot_app.update_queue.put(Update.de_json(await request.get_json(force=True), bot_app.bot))
+    return "", 200
+
+# --- ACCESS GATE ---
+# access_gate runs in handler group -1 of every bot, before any command handler. It drops floods,
+# banned users, guests (except /start) and non-admins using admin commands or admin panel buttons,
+# so the handlers below can assume the caller is allowed in; admin handlers still re-check as a backstop.
+# Roles are cached per user and the cache entry is dropped by persist_role whenever an admin action
+# changes that user's roles.
+ADMIN_COMMANDS = frozenset({"admin", "approvebot", "uptime", "deploy", "approve", "addadmin", "msg", "adminlist", "addprized", "delprized", "restart", "broadcast", "extendvip", "access", "addcommand", "delcommand", "listcommands", "bots", "stopbot", "startbot"})
+ACCESS_CACHE_SIZE = 10000
+
+class UserAccess(NamedTuple):
+    banned: bool
+    authorized: bool
+    admin: bool
+    restricted: bool
+
+ACCESS_CACHE: dict[int, UserAccess] = {}
+FLOOD_BUCKETS: dict[int, TokenBucket] = {}
+
+def user_access(user_id: int) -> UserAccess:
+    access = ACCESS_CACHE.get(user_id)
+    if access is None:
+        if len(ACCESS_CACHE) >= ACCESS_CACHE_SIZE: ACCESS_CACHE.clear()
+        access = ACCESS_CACHE[user_id] = UserAccess(user_id in BANNED_USERS, user_id in AUTHORIZED_USERS, user_id in ADMIN_USERS, user_id in RESTRICTED_USERS)
+    return access
+
+def allow_update_from(user_id: int) -> bool:
+    bucket = FLOOD_BUCKETS.get(user_id)
+    if bucket is None:
+        if len(FLOOD_BUCKETS) >= ACCESS_CACHE_SIZE: prune_full_buckets(FLOOD_BUCKETS)
+        bucket = FLOOD_BUCKETS[user_id] = TokenBucket(FLOOD_RATE, FLOOD_BURST)
+    return bucket.try_acquire()
+
+def command_name(update: Update) -> str | None:
+    message = update.effective_message
+    text = message.text if message else None
+    if not text or not text.startswith('/'): return None
+    return text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+
+async def access_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None: return
+    access = user_access(user.id)
+    if not access.admin and not allow_update_from(user.id): raise ApplicationHandlerStop
+    command, query = command_name(update), update.callback_query
+    if access.banned:
+        if command == "start": await update.message.reply_text("❌ You have been banned from using this bot.")
+        raise ApplicationHandlerStop
+    if command in ADMIN_COMMANDS or (query and query.data and query.data.startswith('admin_')):
+        if access.admin: return
+        if query: await query.answer("❌ You are not authorized for this action.", show_alert=True)
+        raise ApplicationHandlerStop
+    if not access.authorized and command != "start": raise ApplicationHandlerStop
 
 # --- ALL COMMAND HANDLERS ---
 async def send_full_stock_report(update: Update, context: ContextTypes.DEFAULT_TYPE, filters: list[str]):
@@ -291,27 +1511,22 @@ async def send_full_stock_report(update: Update, context: ContextTypes.DEFAULT_T
     if not data: await loader_message.edit_text("⚠️ Could not fetch data."); return None
     
     await loader_message.edit_text("🌦️ Fetching weather report...")
-    weather_report = format_weather_message(data.get("weather", {}))
+    weather_report = render_weather(data)
     weather_msg = await context.bot.send_message(chat_id, text=weather_report, parse_mode=ParseMode.HTML)
     SENT_MESSAGES[chat_id].append(weather_msg.message_id)
     
     await loader_message.edit_text("📊 Syncing stock data...")
-    next_restock_times = calculate_next_restock_times()
-    now = get_ph_time()
     sent_anything = False
-    for category_name, items in data["stock"].items():
-        items_to_show = [item for item in items if not filters or any(f in item['name'].lower() for f in filters)]
-        if items_to_show:
+    for category_name in data.stock:
+        category_message = render_category(data, category_name, filters)
+        if category_message:
             sent_anything = True
-            time_left = next_restock_times.get(category_name, now) - now
-            countdown_str = format_timedelta(time_left, short=True)
-            category_message = format_category_message(category_name, items_to_show, countdown_str)
             stock_msg = await context.bot.send_message(chat_id, text=category_message, parse_mode=ParseMode.HTML)
             SENT_MESSAGES[chat_id].append(stock_msg.message_id)
 
     if not sent_anything and filters: await context.bot.send_message(chat_id, text="Your filter didn't match any items.")
     await loader_message.delete()
-    if sent_anything: await send_music_vm(context, chat_id)
+    if sent_anything: await send_music_vm(context.bot, chat_id)
     return data
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -336,20 +1551,17 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['has_received_child_welcome'] = True
             return
 
-    await log_user_activity(user, "/start", context.bot)
-    if user.id in BANNED_USERS: await update.message.reply_text("❌ You have been banned from using this bot."); return
-    if user.id not in AUTHORIZED_USERS:
+    log_user_activity(user, "/start", context.bot)
+    if not user_access(user.id).authorized:
         code = "GAG-" + ''.join(random.choices(string.ascii_uppercase + string.digits, k=3)) + '-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=3))
         user_msg = f"👋 <b>Welcome! This is a private bot.</b>\n\nTo get access, send this code to the admin for approval:\n\n🔑 Approval Code: <code>{code}</code>"
         admin_msg = f"👤 <b>New User Request</b>\n\n<b>Name:</b> {user.first_name}\n<b>User ID:</b> <code>{user.id}</code>\n\nTo approve, use: <code>/approve {user.id}</code>"
         await update.message.reply_html(user_msg)
-        for admin_id in ADMIN_USERS:
-            try: await context.application.bot.send_message(chat_id=admin_id, text=admin_msg, parse_mode=ParseMode.HTML)
-            except Exception as e: logger.error(f"Failed to send approval notice to admin {admin_id}: {e}")
+        await send_to_many(context.application.bot, ADMIN_USERS, admin_msg, "approval notice", parse_mode=ParseMode.HTML)
         return
     if user.id in RESTRICTED_USERS: await update.message.reply_text("⚠️ Your account is restricted. You can refresh stock but cannot start a new tracker. Please contact an admin."); return
-    is_vip = str(user.id) in VIP_USERS and datetime.fromisoformat(VIP_USERS.get(str(user.id), '1970-01-01T00:00:00+00:00')) > datetime.now(pytz.utc)
-    if is_vip:
+    user_is_vip = is_vip(user.id)
+    if user_is_vip:
         chat_id = user.id
         if chat_id in ACTIVE_TRACKERS:
             tracker_version = ACTIVE_TRACKERS[chat_id].get('version', '0.0.0')
@@ -364,15 +1576,13 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         filters = [f.strip().lower() for f in context.args if f.strip()]
         initial_data = await send_full_stock_report(update, context, filters)
         if initial_data:
-            LAST_SENT_DATA[chat_id] = initial_data; task = asyncio.create_task(tracking_loop(chat_id, context.bot, context, filters))
-            ACTIVE_TRACKERS[chat_id] = {'task': task, 'filters': filters, 'is_muted': False, 'first_name': user.first_name, 'version': BOT_VERSION}
+            start_tracking(chat_id, context.bot, filters, user.first_name, initial_data)
             await context.bot.send_message(chat_id, text=f"✅ ⭐ <b>VIP Tracking Activated!</b>\nYou'll get automatic notifications for stock changes.", parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text("This command starts automatic background tracking for <b>VIP members</b>.\n\nAs a regular user, you can use /refresh to check stock at any time.\n\nTo become a VIP, you can <code>/requestvip</code>.", parse_mode=ParseMode.HTML)
 async def next_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/next", context.bot)
+    log_user_activity(user, "/next", context.bot)
     now = get_ph_time(); next_times = calculate_next_restock_times()
     schedule_lines = []
     category_emojis = {"Seed": "🌱", "Gear": "🛠️", "Egg": "🥚", "Honey": "🍯", "Cosmetics": "🎨"}
@@ -387,10 +1597,9 @@ async def next_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_html(message)
 async def register_bot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/registerbot", context.bot)
-    is_vip = str(user.id) in VIP_USERS and datetime.fromisoformat(VIP_USERS.get(str(user.id), '1970-01-01T00:00:00+00:00')) > datetime.now(pytz.utc)
-    if not is_vip:
+    log_user_activity(user, "/registerbot", context.bot)
+    user_is_vip = is_vip(user.id)
+    if not user_is_vip:
         await update.message.reply_html("❌ <b>VIP Membership Required</b>\n\nThis is an exclusive feature for our VIP members. Use /requestvip to learn more.")
         return
     if len(context.args) < 2:
@@ -405,17 +1614,15 @@ async def register_bot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     request_code = f"BRR-{user.id}-{random.randint(1000, 9999)}"
     BOT_REGISTRATION_REQUESTS[request_code] = {"user_id": user.id, "user_first_name": user.first_name, "bot_name": bot_name, "bot_token": token, "bot_username": bot_username}
-    save_json_to_file("bot_registrations.json", BOT_REGISTRATION_REQUESTS)
+    save_row('bot_registrations', request_code, BOT_REGISTRATION_REQUESTS[request_code])
     user_msg = f"⏳ <b>Registration Submitted!</b>\n\nYour request to register '<b>{bot_name}</b>' has been sent to the admins for approval.\n\n<b>Request Code:</b> <code>{request_code}</code>"
     admin_msg = f"🤖 <b>New Bot Registration Request</b>\n\n<b>User:</b> {user.full_name} (<code>{user.id}</code>)\n<b>Requested Bot Name:</b> {bot_name}\n<b>Bot Username:</b> @{bot_username}\n\nTo approve, use: <code>/approvebot {request_code}</code>"
     await update.message.reply_html(user_msg)
-    for admin_id in ADMIN_USERS:
-        try: await context.application.bot.send_message(chat_id=admin_id, text=admin_msg, parse_mode=ParseMode.HTML)
-        except Exception as e: logger.error(f"Failed to send bot reg notice to admin {admin_id}: {e}")
+    await send_to_many(context.application.bot, ADMIN_USERS, admin_msg, "bot reg notice", parse_mode=ParseMode.HTML)
 async def approve_bot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/approvebot", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/approvebot", context.bot)
     if not context.args:
         await update.message.reply_html("⚠️ <b>Usage:</b> <code>/approvebot [request_code]</code>")
         return
@@ -426,13 +1633,11 @@ async def approve_bot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user_id = request_data["user_id"]; bot_name = request_data["bot_name"]; bot_token = request_data["bot_token"]; bot_username = request_data["bot_username"]
     CHILD_BOTS[bot_token] = {"name": bot_name, "owner_id": user_id, "username": bot_username, "approved_by": admin.id, "created_at": datetime.now(pytz.utc).isoformat()}
-    save_json_to_file("child_bots.json", CHILD_BOTS)
+    save_row('child_bots', bot_token, CHILD_BOTS[bot_token])
     del BOT_REGISTRATION_REQUESTS[request_code]
-    save_json_to_file("bot_registrations.json", BOT_REGISTRATION_REQUESTS)
+    delete_row('bot_registrations', request_code)
     logger.info(f"Admin {admin.id} approved bot @{bot_username}. Starting it automatically...")
-    new_bot_app = Application.builder().token(bot_token).build()
-    register_handlers(new_bot_app)
-    asyncio.create_task(run_bot(new_bot_app))
+    if SUPERVISOR.owns(bot_token): SUPERVISOR.start(bot_token)
     await update.message.reply_html(f"✅ <b>Success!</b>\n\nYou have approved @{bot_username}. It is now active and running automatically.")
     success_message = f"🎉 <b>Bot Approved & Activated!</b> 🎉\n\nCongratulations! Your bot '<b>{bot_name}</b>' has been approved and is now online.\n\n➡️ <b>Your bot's link:</b> https://t.me/{bot_username}"
     try:
@@ -442,16 +1647,15 @@ async def approve_bot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_html(f"⚠️ Could not notify the user. Please message them manually.")
 async def deploy_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/deploy", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/deploy", context.bot)
     if not RENDER_DEPLOY_HOOK_URL:
         await update.message.reply_html("⚠️ <b>Deploy Hook Not Configured</b>\n\nThe `RENDER_DEPLOY_HOOK_URL` environment variable is not set. Cannot trigger deployment.")
         return
     msg = await update.message.reply_text("🚀 Sending deployment signal to Render...")
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(RENDER_DEPLOY_HOOK_URL)
-            response.raise_for_status()
+        response = await get_http_client().post(RENDER_DEPLOY_HOOK_URL)
+        response.raise_for_status()
         await msg.edit_text("✅ <b>Success!</b>\n\nDeployment triggered on Render. The bot will restart with the latest code shortly.")
         logger.info(f"Admin {admin.id} triggered a new deployment.")
     except httpx.HTTPStatusError as e:
@@ -460,15 +1664,54 @@ async def deploy_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.edit_text(f"❌ <b>An Error Occurred</b>\n\nCould not trigger deployment. Error: {e}")
 async def uptime_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id not in ADMIN_USERS: return
-    await log_user_activity(user, "/uptime", context.bot)
+    if not user_access(user.id).admin: return
+    log_user_activity(user, "/uptime", context.bot)
     uptime_delta = datetime.now(pytz.utc) - BOT_START_TIME
     uptime_str = format_timedelta(uptime_delta)
     await update.message.reply_html(f"🕒 <b>Bot Uptime:</b> {uptime_str}")
+def find_bot_token(query: str) -> str | None:
+    query = query.lstrip('@').lower()
+    if query == "main": return TOKEN
+    return next((token for token, info in CHILD_BOTS.items() if (info.get('username') or '').lower() == query or token.endswith(query)), None)
+async def bots_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user_access(user.id).admin: return
+    log_user_activity(user, "/bots", context.bot)
+    state_icons = {'running': "🟢", 'starting': "🟡", 'backoff': "🟠", 'stopped': "⚪", 'quarantined': "⛔"}
+    lines = []
+    for runner in SUPERVISOR.runners.values():
+        name = "main" if runner.token == TOKEN else f"@{CHILD_BOTS.get(runner.token, {}).get('username', '...' + runner.token[-4:])}"
+        line = f"{state_icons.get(runner.state, '❔')} <b>{name}</b> · {runner.state}"
+        if runner.state == 'running' and runner.started_at: line += f" · {runner.mode} · up {format_timedelta(datetime.now(pytz.utc) - runner.started_at, short=True)}"
+        if runner.failures: line += f" · {runner.failures} failure(s)"
+        if runner.last_error and runner.state != 'running': line += f"\n   <i>{html.escape(runner.last_error[:120])}</i>"
+        lines.append(line)
+    message = f"🤖 <b>Bots in shard {BOT_SHARD_INDEX}</b>\n\n" + ("\n".join(lines) or "<i>No bots are supervised here.</i>")
+    if SUPERVISOR.workers: message += "\n\n<b>Shard workers</b>\n" + "\n".join(f"• Shard {index}: pid {proc.pid}" + (" (running)" if proc.returncode is None else f" (exited {proc.returncode})") for index, proc in sorted(SUPERVISOR.workers.items()))
+    await update.message.reply_html(message)
+async def stopbot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user_access(user.id).admin: return
+    log_user_activity(user, "/stopbot", context.bot)
+    token = find_bot_token(context.args[0]) if context.args else None
+    if token is None: await update.message.reply_html("⚠️ <b>Usage:</b> <code>/stopbot [@username | main]</code>"); return
+    if token == context.bot.token: await update.message.reply_text("⚠️ A bot can't stop itself; use another bot or /restart."); return
+    if not SUPERVISOR.owns(token): await update.message.reply_text(f"⚠️ That bot runs in shard {shard_for(token)}; use a bot from that shard."); return
+    if await SUPERVISOR.stop(token): await update.message.reply_text("🛑 Bot stopped. Use /startbot to bring it back.")
+    else: await update.message.reply_text("⚠️ That bot isn't running.")
+async def startbot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user_access(user.id).admin: return
+    log_user_activity(user, "/startbot", context.bot)
+    token = find_bot_token(context.args[0]) if context.args else None
+    if token is None: await update.message.reply_html("⚠️ <b>Usage:</b> <code>/startbot [@username | main]</code>"); return
+    if not SUPERVISOR.owns(token): await update.message.reply_text(f"⚠️ That bot runs in shard {shard_for(token)}; use a bot from that shard."); return
+    SUPERVISOR.start(token)
+    await update.message.reply_text("▶️ Bot is starting. Check /bots for its status.")
 async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id not in ADMIN_USERS: return
-    await log_user_activity(user, "/admin", context.bot)
+    if not user_access(user.id).admin: return
+    log_user_activity(user, "/admin", context.bot)
     base_url = os.environ.get('RENDER_EXTERNAL_URL', f'http://localhost:{os.environ.get("PORT", 8080)}')
     dashboard_url = f"{base_url}/login"
     keyboard = [[InlineKeyboardButton("🌐 Open Dashboard", url=dashboard_url)],[InlineKeyboardButton("👤 Manage Authorized", callback_data='admin_users_0')],[InlineKeyboardButton("⚠️ Manage Restricted", callback_data='admin_restricted_0')],[InlineKeyboardButton("🚫 Manage Banned", callback_data='admin_banned_0')],[InlineKeyboardButton("💎 Prized Items", callback_data='admin_prized')],[InlineKeyboardButton("📊 Bot Stats", callback_data='admin_stats')],[InlineKeyboardButton("📢 Broadcast Message", callback_data='admin_broadcast')],[InlineKeyboardButton("❌ Close", callback_data='admin_close')]]
@@ -484,8 +1727,7 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else: await message_to_use.reply_html(f"👑 <b>{ADMIN_PANEL_TITLE}</b>\n\nSelect an action.", reply_markup=reply_markup)
 async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query; await query.answer()
-    admin_id = query.from_user.id
-    if admin_id not in ADMIN_USERS: await query.edit_message_text("❌ You are not authorized for this action."); return
+    if not user_access(query.from_user.id).admin: return
     data = query.data.split('_'); command = data[0]
     if command != "admin": return
     action = data[1]
@@ -518,24 +1760,24 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             if target_id in BANNED_USERS: status, status_icon = "Banned", "🚫"
             elif target_id in RESTRICTED_USERS: status, status_icon = "Restricted", "⚠️"
             elif target_id in ADMIN_USERS: status, status_icon = "Admin", "👑"
-            if str(target_id) in VIP_USERS and datetime.fromisoformat(VIP_USERS.get(str(target_id), '1970-01-01T00:00:00+00:00')) > datetime.now(pytz.utc): status += " (VIP)"
+            if is_vip(target_id): status += " (VIP)"
             keyboard = [[InlineKeyboardButton("✅ Unban" if target_id in BANNED_USERS else "🚫 Ban", callback_data=f"admin_user_unban_{target_id}" if target_id in BANNED_USERS else f"admin_user_ban_{target_id}")],[InlineKeyboardButton("✅ Unrestrict" if target_id in RESTRICTED_USERS else "⚠️ Restrict", callback_data=f"admin_user_unrestrict_{target_id}" if target_id in RESTRICTED_USERS else f"admin_user_restrict_{target_id}")],[InlineKeyboardButton("Demote" if target_id in ADMIN_USERS else "👑 Promote", callback_data=f"admin_user_deladmin_{target_id}" if target_id in ADMIN_USERS else f"admin_user_addadmin_{target_id}")],[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data='admin_main')]]
             await query.edit_message_text(f"<b>Managing:</b> {user_info['first_name']}\n<b>ID:</b> <code>{target_id}</code>\n<b>Status:</b> {status_icon} {status}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
             return
         if target_id == BOT_OWNER_ID: await query.edit_message_text("❌ This action cannot be performed on the bot owner."); return
         text = ""
-        if action_type == "ban": BANNED_USERS.add(target_id); AUTHORIZED_USERS.discard(target_id); RESTRICTED_USERS.discard(target_id); VIP_USERS.pop(str(target_id), None); save_to_file("banned_users.txt", BANNED_USERS); save_to_file("authorized_users.txt", AUTHORIZED_USERS); save_to_file("restricted_users.txt", RESTRICTED_USERS); save_json_to_file("vips.json", VIP_USERS); text = f"🚫 User {target_id} has been banned."
-        elif action_type == "unban": BANNED_USERS.discard(target_id); AUTHORIZED_USERS.add(target_id); save_to_file("banned_users.txt", BANNED_USERS); save_to_file("authorized_users.txt", AUTHORIZED_USERS); text = f"✅ User {target_id} has been unbanned."
-        elif action_type == "restrict": RESTRICTED_USERS.add(target_id); save_to_file("restricted_users.txt", RESTRICTED_USERS); text = f"⚠️ User {target_id} is now restricted."
-        elif action_type == "unrestrict": RESTRICTED_USERS.discard(target_id); save_to_file("restricted_users.txt", RESTRICTED_USERS); text = f"✅ User {target_id} is no longer restricted."
-        elif action_type == "addadmin": ADMIN_USERS.add(target_id); save_to_file("admins.txt", ADMIN_USERS); text = f"👑 User {target_id} is now an admin."
-        elif action_type == "deladmin": ADMIN_USERS.discard(target_id); save_to_file("admins.txt", ADMIN_USERS); text = f"User {target_id} is no longer an admin."
+        if action_type == "ban": BANNED_USERS.add(target_id); AUTHORIZED_USERS.discard(target_id); RESTRICTED_USERS.discard(target_id); VIP_USERS.remove(target_id); persist_role(target_id, 'banned', True); persist_role(target_id, 'authorized', False); persist_role(target_id, 'restricted', False); text = f"🚫 User {target_id} has been banned."
+        elif action_type == "unban": BANNED_USERS.discard(target_id); AUTHORIZED_USERS.add(target_id); persist_role(target_id, 'banned', False); persist_role(target_id, 'authorized', True); text = f"✅ User {target_id} has been unbanned."
+        elif action_type == "restrict": RESTRICTED_USERS.add(target_id); persist_role(target_id, 'restricted', True); text = f"⚠️ User {target_id} is now restricted."
+        elif action_type == "unrestrict": RESTRICTED_USERS.discard(target_id); persist_role(target_id, 'restricted', False); text = f"✅ User {target_id} is no longer restricted."
+        elif action_type == "addadmin": ADMIN_USERS.add(target_id); persist_role(target_id, 'admin', True); text = f"👑 User {target_id} is now an admin."
+        elif action_type == "deladmin": ADMIN_USERS.discard(target_id); persist_role(target_id, 'admin', False); text = f"User {target_id} is no longer an admin."
         await query.edit_message_text(text); await asyncio.sleep(2); await admin_cmd(update, context)
         return
     if action == "stats":
         uptime_delta = datetime.now(pytz.utc) - BOT_START_TIME
-        uptime_str = format_timedelta(uptime_delta)
-        text = f"📊 <b>Bot Statistics</b>\n\n- <b>Uptime:</b> {uptime_str}\n- <b>Authorized Users:</b> {len(AUTHORIZED_USERS)}\n- <b>VIP Members:</b> {len([uid for uid, exp in VIP_USERS.items() if datetime.fromisoformat(exp) > datetime.now(pytz.utc)])}\n- <b>Admins:</b> {len(ADMIN_USERS)}\n- <b>Active Trackers:</b> {len(ACTIVE_TRACKERS)}\n- <b>Banned Users:</b> {len(BANNED_USERS)}\n- <b>Restricted Users:</b> {len(RESTRICTED_USERS)}\n- <b>Recent Activities Logged:</b> {len(USER_ACTIVITY)}"
+        uptime_str = format_timedelta(uptime_delta); send_stats = dispatcher_stats()
+        text = f"📊 <b>Bot Statistics</b>\n\n- <b>Uptime:</b> {uptime_str}\n- <b>Authorized Users:</b> {len(AUTHORIZED_USERS)}\n- <b>VIP Members:</b> {len(VIP_USERS)}\n- <b>Admins:</b> {len(ADMIN_USERS)}\n- <b>Active Trackers:</b> {len(ACTIVE_TRACKERS)}\n- <b>Banned Users:</b> {len(BANNED_USERS)}\n- <b>Restricted Users:</b> {len(RESTRICTED_USERS)}\n- <b>Recent Activities Logged:</b> {len(USER_ACTIVITY)}\n- <b>Outbound Queue:</b> {send_stats['queued']} queued, {send_stats['per_second']:.1f} msg/s ({send_stats['sent']} sent, {send_stats['failed']} failed)"
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data='admin_main')]]), parse_mode=ParseMode.HTML)
     elif action == "prized":
         message = "💎 <b>Current Prized Items:</b>\n\n" + ("\n".join([f"• <code>{item}</code>" for item in sorted(list(PRIZED_ITEMS))]) or "The list is empty.")
@@ -544,21 +1786,21 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.reply_text("Please use the command: <code>/broadcast [your message]</code>", parse_mode=ParseMode.HTML)
 async def approve_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user;
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, f"/approve", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, f"/approve", context.bot)
     try:
         target_id = int(context.args[0])
         if target_id in AUTHORIZED_USERS: await update.message.reply_text("This user is already authorized."); return
-        AUTHORIZED_USERS.add(target_id); save_to_file("authorized_users.txt", AUTHORIZED_USERS)
+        AUTHORIZED_USERS.add(target_id); persist_role(target_id, 'authorized', True)
         
         user_id_str = str(target_id)
         if user_id_str not in USER_INFO_CACHE: USER_INFO_CACHE[user_id_str] = {}
         USER_INFO_CACHE[user_id_str]['approved_date'] = datetime.now(pytz.utc).isoformat()
-        save_json_to_file("user_info.json", USER_INFO_CACHE)
+        save_row('users', target_id, USER_INFO_CACHE[user_id_str])
 
         try:
             target_user = await context.bot.get_chat(target_id)
-            await log_user_activity(target_user, "[Approved]", context.bot)
+            log_user_activity(target_user, "[Approved]", context.bot)
         except Exception as e: logger.error(f"Could not get chat for newly approved user {target_id}: {e}")
         await update.message.reply_text(f"✅ User <code>{target_id}</code> has been authorized!", parse_mode=ParseMode.HTML)
         await context.bot.send_message(chat_id=target_id, text="🎉 <b>You have been approved!</b>\n\nYou can now use the bot's commands. See /help for details.")
@@ -567,20 +1809,20 @@ async def approve_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e: await update.message.reply_text(f"❌ Error approving user: {e}")
 async def add_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user;
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, f"/addadmin", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, f"/addadmin", context.bot)
     try:
         target_id = int(context.args[0])
         if target_id in ADMIN_USERS: await update.message.reply_text("This user is already an admin."); return
-        ADMIN_USERS.add(target_id); save_to_file("admins.txt", ADMIN_USERS)
-        if target_id not in AUTHORIZED_USERS: AUTHORIZED_USERS.add(target_id); save_to_file("authorized_users.txt", AUTHORIZED_USERS)
+        ADMIN_USERS.add(target_id); persist_role(target_id, 'admin', True)
+        if target_id not in AUTHORIZED_USERS: AUTHORIZED_USERS.add(target_id); persist_role(target_id, 'authorized', True)
         await update.message.reply_text(f"👑 User <code>{target_id}</code> is now an admin!", parse_mode=ParseMode.HTML)
         await context.bot.send_message(chat_id=target_id, text="🛡️ <b>You have been promoted to an Admin!</b>")
     except (IndexError, ValueError): await update.message.reply_text("Usage: <code>/addadmin [user_id]</code>", parse_mode=ParseMode.HTML)
 async def msg_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user;
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, f"/msg", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, f"/msg", context.bot)
     try:
         if len(context.args) < 2: await update.message.reply_text("⚠️ Usage: <code>/msg [user_id] [your message]</code>", parse_mode=ParseMode.HTML); return
         target_id, message_text = int(context.args[0]), " ".join(context.args[1:])
@@ -592,8 +1834,8 @@ async def msg_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e: await update.message.reply_text(f"❌ Could not send message. Error: {e}")
 async def adminlist_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user;
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/adminlist", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/adminlist", context.bot)
     admin_list_text = "<b>🛡️ Current Bot Admins</b>\n\n"
     for admin_id in ADMIN_USERS:
         info = USER_INFO_CACHE.get(str(admin_id), {'first_name': f"Admin {admin_id}", 'username': 'N/A'})
@@ -601,176 +1843,219 @@ async def adminlist_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_html(admin_list_text)
 async def addprized_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user;
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, f"/addprized", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, f"/addprized", context.bot)
     item_name = " ".join(context.args).lower().strip()
     if not item_name: await update.message.reply_text("Usage: <code>/addprized [item name]</code>", parse_mode=ParseMode.HTML); return
-    PRIZED_ITEMS.add(item_name); save_to_file("prized_items.txt", PRIZED_ITEMS)
+    PRIZED_ITEMS.add(item_name); save_row('prized_items', item_name)
     await update.message.reply_text(f"✅ '<code>{item_name}</code>' has been added to the prized list.", parse_mode=ParseMode.HTML)
 async def delprized_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user;
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, f"/delprized", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, f"/delprized", context.bot)
     item_name = " ".join(context.args).lower().strip()
     if not item_name: await update.message.reply_text("Usage: <code>/delprized [item name]</code>", parse_mode=ParseMode.HTML); return
-    PRIZED_ITEMS.discard(item_name); save_to_file("prized_items.txt", PRIZED_ITEMS)
+    PRIZED_ITEMS.discard(item_name); delete_row('prized_items', item_name)
     await update.message.reply_text(f"🗑️ '<code>{item_name}</code>' has been removed from the prized list.", parse_mode=ParseMode.HTML)
 async def listprized_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/listprized", context.bot)
+    log_user_activity(user, "/listprized", context.bot)
     if not PRIZED_ITEMS: message = "The prized item list is currently empty."
     else: message = "💎 <b>Current Prized Items:</b>\n\n" + "\n".join([f"• <code>{item}</code>" for item in sorted(list(PRIZED_ITEMS))])
     await update.message.reply_html(message)
 async def restart_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/restart", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/restart", context.bot)
     await update.message.reply_text("🚀 Gracefully restarting the bot now...")
+    prepare_for_exec()
     os.execv(sys.executable, ['python'] + sys.argv)
 async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/broadcast", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/broadcast", context.bot)
     message_to_send = " ".join(context.args)
     if not message_to_send: await update.message.reply_text("Usage: <code>/broadcast [your message]</code>", parse_mode=ParseMode.HTML); return
     broadcast_message = f"📣 <b>Broadcast from Admin:</b>\n\n<i>{message_to_send}</i>"
-    sent_count = 0
     await update.message.reply_text(f"Sending broadcast to {len(AUTHORIZED_USERS)} users...")
-    for user_id in AUTHORIZED_USERS:
-        if user_id not in BANNED_USERS:
-            try: await context.bot.send_message(chat_id=user_id, text=broadcast_message, parse_mode=ParseMode.HTML); sent_count += 1; await asyncio.sleep(0.1)
-            except Exception as e: logger.error(f"Failed to send broadcast to {user_id}: {e}")
+    sent_count = await send_to_many(context.bot, AUTHORIZED_USERS - BANNED_USERS, broadcast_message, "broadcast", parse_mode=ParseMode.HTML)
     await update.message.reply_text(f"✅ Broadcast complete. Message sent to {sent_count} users.")
 async def extendvip_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/extendvip", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/extendvip", context.bot)
     try:
         if len(context.args) != 2: raise ValueError
         target_id, days = int(context.args[0]), int(context.args[1])
         if target_id not in AUTHORIZED_USERS: await update.message.reply_text("❌ This user must be authorized first."); return
-        current_expiration_str = VIP_USERS.get(str(target_id))
-        current_expiration = datetime.fromisoformat(current_expiration_str) if current_expiration_str else datetime.now(pytz.utc)
-        if current_expiration < datetime.now(pytz.utc): current_expiration = datetime.now(pytz.utc)
+        current_expiration = max(VIP_USERS.get(target_id) or datetime.now(pytz.utc), datetime.now(pytz.utc))
         new_expiration = current_expiration + timedelta(days=days)
-        VIP_USERS[str(target_id)] = new_expiration.isoformat(); save_json_to_file("vips.json", VIP_USERS)
+        VIP_USERS.set(target_id, new_expiration)
         await update.message.reply_text(f"✅ VIP status for user <code>{target_id}</code> extended by {days} days. New expiration: {new_expiration.strftime('%B %d, %Y')}", parse_mode=ParseMode.HTML)
         await context.bot.send_message(chat_id=target_id, text=f"🎉 Your VIP status has been extended! It now expires on {new_expiration.strftime('%B %d, %Y')}.")
     except (IndexError, ValueError): await update.message.reply_text("⚠️ Usage: <code>/extendvip [user_id] [days]</code>", parse_mode=ParseMode.HTML)
 async def access_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/access", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/access", context.bot)
     if len(context.args) != 1:
         await update.message.reply_text("⚠️ Usage: <code>/access [ticket_code]</code>", parse_mode=ParseMode.HTML); return
     ticket_code = context.args[0]
     if ticket_code in VIP_REQUESTS:
         target_id = VIP_REQUESTS[ticket_code]
-        del VIP_REQUESTS[ticket_code]; save_json_to_file("vip_requests.json", VIP_REQUESTS)
-        expiration_date = datetime.now(pytz.utc) + timedelta(days=30); VIP_USERS[str(target_id)] = expiration_date.isoformat(); save_json_to_file("vips.json", VIP_USERS)
+        del VIP_REQUESTS[ticket_code]; delete_row('vip_requests', ticket_code)
+        expiration_date = datetime.now(pytz.utc) + timedelta(days=30); VIP_USERS.set(target_id, expiration_date)
         user_info = USER_INFO_CACHE.get(str(target_id), {'first_name': f'User {target_id}'})
         await update.message.reply_text(f"✅ <b>VIP Access Granted!</b>\n\nUser {user_info['first_name']} (<code>{target_id}</code>) is now a VIP until {expiration_date.strftime('%B %d, %Y')}.", parse_mode=ParseMode.HTML)
         await context.bot.send_message(chat_id=target_id, text=f"🎉 <b>Congratulations!</b>\n\nYour VIP access has been granted and is active until {expiration_date.strftime('%B %d, %Y')}.\n\nUse /start to activate VIP tracking!")
-        await log_user_activity(admin, f"[VIP Granted for {target_id}]", context.bot)
+        log_user_activity(admin, f"[VIP Granted for {target_id}]", context.bot)
     else:
         await update.message.reply_text("❌ Invalid or expired VIP ticket code.")
 async def requestvip_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/requestvip", context.bot)
+    log_user_activity(user, "/requestvip", context.bot)
     nickname = user.first_name.split(" ")[0].capitalize().replace(" ", "")
     random_part = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
     ticket_code = f"{nickname}-{random_part}"
-    VIP_REQUESTS[ticket_code] = user.id; save_json_to_file("vip_requests.json", VIP_REQUESTS)
+    VIP_REQUESTS[ticket_code] = user.id; save_row('vip_requests', ticket_code, {'user_id': user.id})
     user_msg = f"✨ <b>Your VIP Access Ticket is Ready!</b> ✨\n\nTo complete your request, please send the following ticket code to an admin:\n\n🎫 <b>Ticket Code:</b> <code>{ticket_code}</code>\n\n<i>(Click the code to copy it)</i>"
     admin_msg = f"⭐ <b>New VIP Request Ticket</b>\n\n<b>User:</b> {user.full_name} (<code>{user.id}</code>)\n<b>Ticket Code:</b> <code>{ticket_code}</code>\n\nTo approve, use: <code>/access {ticket_code}</code>"
     await update.message.reply_html(user_msg)
-    for admin_id in ADMIN_USERS:
-        try: await context.application.bot.send_message(chat_id=admin_id, text=admin_msg, parse_mode=ParseMode.HTML)
-        except Exception as e: logger.error(f"Failed to send VIP request notice to admin {admin_id}: {e}")
+    await send_to_many(context.application.bot, ADMIN_USERS, admin_msg, "VIP request notice", parse_mode=ParseMode.HTML)
+async def render_custom_response(message, response: str) -> str:
+    """Sends `response` as HTML and returns the form that rendered; text Telegram can't parse is stored escaped."""
+    try: await message.reply_html(response); return response
+    except BadRequest as e:
+        if "parse entities" not in str(e): raise
+        response = html.escape(response); await message.reply_html(response); return response
 async def addcommand_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/addcommand", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/addcommand", context.bot)
     try:
         if len(context.args) < 3: raise ValueError
         name, permission, response = context.args[0].lower(), context.args[1].lower(), " ".join(context.args[2:])
         if not name.isalnum(): await update.message.reply_text("❌ Command name can only contain letters and numbers."); return
         if permission not in ["user", "admin", "both"]: await update.message.reply_text("❌ Permission must be 'user', 'admin', or 'both'."); return
-        CUSTOM_COMMANDS[name] = {"response": response, "permission": permission}; save_json_to_file("custom_commands.json", CUSTOM_COMMANDS)
-        await update.message.reply_text(f"✅ Custom command `/{name}` created!\n\nUse /restart for the new command to become active.", parse_mode=ParseMode.HTML)
+        if name in COMMAND_HANDLERS: await update.message.reply_text(f"❌ /{name} is a built-in command."); return
+        response = await render_custom_response(update.message, response)
+        CUSTOM_COMMANDS[name] = {"response": response, "permission": permission}; save_row('custom_commands', name, CUSTOM_COMMANDS[name])
+        await update.message.reply_text(f"✅ Custom command `/{name}` created! It is live on every bot now and replies as shown above.", parse_mode=ParseMode.HTML)
     except (IndexError, ValueError): await update.message.reply_text("⚠️ Usage: <code>/addcommand [name] [permission] [response]</code>\n\n- <b>Permission</b> can be: user, admin, or both.", parse_mode=ParseMode.HTML)
 async def delcommand_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = update.effective_user
-    if admin.id not in ADMIN_USERS: return
-    await log_user_activity(admin, "/delcommand", context.bot)
+    if not user_access(admin.id).admin: return
+    log_user_activity(admin, "/delcommand", context.bot)
     try:
         name = context.args[0].lower()
         if name in CUSTOM_COMMANDS:
-            del CUSTOM_COMMANDS[name]; save_json_to_file("custom_commands.json", CUSTOM_COMMANDS)
-            await update.message.reply_text(f"🗑️ Custom command `/{name}` deleted.\n\nUse /restart for this change to take effect.", parse_mode=ParseMode.HTML)
+            del CUSTOM_COMMANDS[name]; delete_row('custom_commands', name)
+            await update.message.reply_text(f"🗑️ Custom command `/{name}` deleted.", parse_mode=ParseMode.HTML)
         else: await update.message.reply_text(f"❌ Command `/{name}` not found.")
     except IndexError: await update.message.reply_text("⚠️ Usage: <code>/delcommand [name]</code>", parse_mode=ParseMode.HTML)
 async def listcommands_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id not in ADMIN_USERS: return
-    await log_user_activity(user, "/listcommands", context.bot)
+    if not user_access(user.id).admin: return
+    log_user_activity(user, "/listcommands", context.bot)
     if not CUSTOM_COMMANDS: await update.message.reply_text("There are no custom commands currently set."); return
     message = "<b>🔧 Custom Commands List</b>\n\n" + "\n".join([f"• <code>/{name}</code> (Permission: {data['permission']})" for name, data in CUSTOM_COMMANDS.items()])
     await update.message.reply_html(message)
+async def custom_command_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # CUSTOM_COMMANDS is read on every call, so /addcommand and /delcommand apply to all bots at once.
+    name = command_name(update)
+    command = CUSTOM_COMMANDS.get(name) if name else None
+    if command is None: return
+    user = update.effective_user; access = user_access(user.id)
+    allowed = {"admin": access.admin, "user": access.authorized and not access.admin, "both": access.authorized}.get(command['permission'], False)
+    if not allowed: return
+    log_user_activity(user, f"/{name}", context.bot)
+    response = await render_custom_response(update.message, command['response'])
+    # Only a response saved before /addcommand checked it can differ; it is stored escaped from now on.
+    if response != command['response']: command['response'] = response; save_row('custom_commands', name, command)
 async def recent_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user;
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/recent", context.bot)
-    chat_data = LAST_SENT_DATA.get(user.id)
-    if not chat_data or not chat_data.get("stock"): await update.message.reply_text("I don't have recent stock data. Please run /start or /refresh."); return
-    recent_items = [items[0] for items in chat_data["stock"].values() if items]
-    if not recent_items: await update.message.reply_text("The stock is completely empty right now."); return
-    message = "<b>📈 Most Recent Stock Items</b>\n\n" + "\n".join([f"• {add_emoji(i['name'])}: {format_value(i['value'])}" for i in recent_items])
+    log_user_activity(user, "/recent", context.bot)
+    recent_items = await asyncio.to_thread(STOCK_HISTORY.recent_appearances, 10)
+    if not recent_items: await update.message.reply_text("No stock history has been recorded yet."); return
+    message = "<b>📈 Most Recent Stock Items</b>\n\n" + "\n".join([f"• {add_emoji(row['name'])}: {format_value(row['value'])} <i>({format_ago(row['ts'])} ago)</i>" for row in recent_items])
+    await update.message.reply_html(message)
+async def lastseen_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    log_user_activity(user, "/lastseen", context.bot)
+    if not context.args: await update.message.reply_text("Usage: /lastseen <item name>"); return
+    item = await asyncio.to_thread(STOCK_HISTORY.find_item, " ".join(context.args))
+    if not item: await update.message.reply_text("I have no history for that item."); return
+    item_id, name = item
+    seen = await asyncio.to_thread(STOCK_HISTORY.last_seen, item_id)
+    if not seen: await update.message.reply_html(f"🕒 <b>{add_emoji(name)}</b> hasn't appeared since history started."); return
+    in_stock = LAST_SNAPSHOT is not None and any(i.name == name for items in LAST_SNAPSHOT.stock.values() for i in items)
+    message = f"🕒 <b>{add_emoji(name)}</b> last appeared <b>{format_ago(seen['ts'])}</b> ago in {seen['category']} ({format_value(seen['value'])})."
+    if in_stock: message += "\n✅ It is in stock right now!"
     await update.message.reply_html(message)
+async def frequency_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    log_user_activity(user, "/frequency", context.bot)
+    args = list(context.args)
+    days = int(args.pop()) if len(args) > 1 and args[-1].isdigit() else 7
+    days = max(1, min(days, int(HISTORY_RETENTION_DAYS)))
+    if not args: await update.message.reply_text("Usage: /frequency <item name> [days]"); return
+    item = await asyncio.to_thread(STOCK_HISTORY.find_item, " ".join(args))
+    if not item: await update.message.reply_text("I have no history for that item."); return
+    item_id, name = item
+    stats = await asyncio.to_thread(STOCK_HISTORY.appearances, item_id, int(time.time() - days * 86400))
+    message = f"📆 <b>{add_emoji(name)}</b> — last {days} day(s)\n\n• Appearances: <b>{stats['count']}</b> ({stats['count'] / days:.1f}/day)"
+    if stats['count']: message += f"\n• Avg quantity: x{stats['avg_value']:.1f} (max {format_value(stats['max_value'])})"
+    await update.message.reply_html(message)
+async def odds_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    log_user_activity(user, "/odds", context.bot)
+    if not RESTOCK_STATS.restocks: await update.message.reply_text("Not enough stock history yet to estimate odds."); return
+    if context.args:
+        key = RESTOCK_STATS.find(" ".join(context.args))
+        if key is None: await update.message.reply_text("I haven't seen that item in any recorded restock."); return
+        lines = []
+        for category_name, chance, counts in RESTOCK_STATS.odds(key):
+            seen = sum(counts.values()); common = counts.most_common(1)[0][0]
+            lines.append(f"• <b>{category_name}</b>: {chance:.1%} per restock ({seen} of {RESTOCK_STATS.restocks[category_name]})\n   Quantity {format_value(min(counts))}–{format_value(max(counts))}, usually {format_value(common)} · next restock in {restock_countdown(category_name)}")
+        await update.message.reply_html(f"🎲 <b>{add_emoji(RESTOCK_STATS.names[key])}</b> (last {ODDS_WINDOW_DAYS:g} days)\n\n" + "\n".join(lines)); return
+    lines = []
+    for key in sorted(PRIZED_ITEMS):
+        for category_name, chance, _ in RESTOCK_STATS.odds(key)[:1]: lines.append(f"• {add_emoji(RESTOCK_STATS.names[key])} ({category_name}): {chance:.1%} · next restock in {restock_countdown(category_name)}")
+    if not lines: lines.append("<i>No prized item has appeared in recorded history yet.</i>")
+    await update.message.reply_html(f"🎲 <b>Prized Item Odds</b> (per restock, last {ODDS_WINDOW_DAYS:g} days)\n\n" + "\n".join(lines) + "\n\nUse <code>/odds [item]</code> for any item.")
 async def stop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/stop", context.bot); chat_id = user.id
-    if chat_id in ACTIVE_TRACKERS: ACTIVE_TRACKERS[chat_id]['task'].cancel(); await update.message.reply_text("🛑 Tracking stopped.")
+    log_user_activity(user, "/stop", context.bot); chat_id = user.id
+    if stop_tracking(chat_id): await update.message.reply_text("🛑 Tracking stopped.")
     else: await update.message.reply_text("⚠️ Not tracking anything.")
 async def refresh_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/refresh", context.bot); filters = ACTIVE_TRACKERS.get(user.id, {}).get('filters', [])
+    log_user_activity(user, "/refresh", context.bot); filters = ACTIVE_TRACKERS.get(user.id, {}).get('filters', [])
     await send_full_stock_report(update, context, filters)
 async def mute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/mute", context.bot); chat_id = user.id; tracker_info = ACTIVE_TRACKERS.get(chat_id)
+    log_user_activity(user, "/mute", context.bot); chat_id = user.id; tracker_info = ACTIVE_TRACKERS.get(chat_id)
     if not tracker_info: await update.message.reply_text("⚠️ Not tracking. Use /start first."); return
     if tracker_info.get('is_muted'): await update.message.reply_text("Notifications already muted.")
-    else: tracker_info['is_muted'] = True; await update.message.reply_text("🔇 Notifications muted. Use /unmute to resume.")
+    else: tracker_info['is_muted'] = True; persist_tracker(chat_id); publish_tracker(chat_id); await update.message.reply_text("🔇 Notifications muted. Use /unmute to resume.")
 async def unmute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/unmute", context.bot); chat_id = user.id; tracker_info = ACTIVE_TRACKERS.get(chat_id)
+    log_user_activity(user, "/unmute", context.bot); chat_id = user.id; tracker_info = ACTIVE_TRACKERS.get(chat_id)
     if not tracker_info: await update.message.reply_text("⚠️ Not tracking. Use /start first."); return
     if not tracker_info.get('is_muted'): await update.message.reply_text("Notifications already on.")
-    else: tracker_info['is_muted'] = False; await update.message.reply_text("🔊 Notifications resumed!")
+    else: tracker_info['is_muted'] = False; persist_tracker(chat_id); publish_tracker(chat_id); await update.message.reply_text("🔊 Notifications resumed!")
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS: return
-    if user.id not in AUTHORIZED_USERS:
-        # Silently ignore unauthorized users for most commands to prevent spam
-        return
-    await log_user_activity(user, "/help", context.bot)
-    is_vip = str(user.id) in VIP_USERS and datetime.fromisoformat(VIP_USERS.get(str(user.id), '1970-01-01T00:00:00+00:00')) > datetime.now(pytz.utc)
-    guide = f"📘 <b>GAG Stock Alerter Guide</b> (v{BOT_VERSION})\n\n<b><u>👤 User Commands</u></b>\n▶️  <b>/start</b> › " + ("Starts VIP background tracking." if is_vip else "Shows current stock.") + "\n🔄  <b>/refresh</b> › Manually shows current stock.\n🗓️  <b>/next</b> › Shows the next restock schedule.\n🤖  <b>/registerbot</b> <code>[token] [name]</code> › Register your own bot (VIP Only).\n📈  <b>/recent</b> › Shows recent items.\n📊  <b>/stats</b> › View your personal bot usage stats.\n💎  <b>/listprized</b> › Shows the prized items list.\n"
-    if not is_vip: guide += "⭐  <b>/requestvip</b> › Request a ticket for VIP status.\n"
-    if is_vip: guide += "🔇  <b>/mute</b> & 🔊 <b>/unmute</b> › Toggles VIP notifications.\n⏹️  <b>/stop</b> › Stops the VIP tracker completely.\n"
-    if user.id in ADMIN_USERS: guide += "\n<b><u>🛡️ Admin Commands</u></b>\n👑  <b>/admin</b> › Opens the main admin panel.\n🤖  <b>/approvebot</b> <code>[code]</code> › Approves a new user bot.\n🚀  <b>/deploy</b> › Triggers a new deployment on Render.\n🕒  <b>/uptime</b> › Shows the bot's current running time.\n📢  <b>/broadcast</b> <code>[msg]</code> › Send a message to all users.\n✉️  <b>/msg</b> <code>[id] [msg]</code> › Sends a message to a user.\n✅  <b>/approve</b> <code>[id]</code> › Authorizes a new user.\n🎟️  <b>/access</b> <code>[ticket]</code> › Grants VIP using a ticket code.\n⏳  <b>/extendvip</b> <code>[id] [days]</code> › Extends a user's VIP.\n➕  <b>/addprized</b> <code>[item]</code> › Adds to prized list.\n➖  <b>/delprized</b> <code>[item]</code> › Removes from prized list.\n🚀  <b>/restart</b> › Restarts the bot process.\n"
+    log_user_activity(user, "/help", context.bot)
+    user_is_vip = is_vip(user.id)
+    guide = f"📘 <b>GAG Stock Alerter Guide</b> (v{BOT_VERSION})\n\n<b><u>👤 User Commands</u></b>\n▶️  <b>/start</b> › " + ("Starts VIP background tracking." if user_is_vip else "Shows current stock.") + "\n🔄  <b>/refresh</b> › Manually shows current stock.\n🗓️  <b>/next</b> › Shows the next restock schedule.\n🤖  <b>/registerbot</b> <code>[token] [name]</code> › Register your own bot (VIP Only).\n📈  <b>/recent</b> › Shows recent items.\n🕒  <b>/lastseen</b> <code>[item]</code> › When an item last appeared.\n📆  <b>/frequency</b> <code>[item] [days]</code> › How often an item appeared.\n🎲  <b>/odds</b> <code>[item]</code> › Chance of an item per restock.\n📊  <b>/stats</b> › View your personal bot usage stats.\n💎  <b>/listprized</b> › Shows the prized items list.\n"
+    if not user_is_vip: guide += "⭐  <b>/requestvip</b> › Request a ticket for VIP status.\n"
+    if user_is_vip: guide += "🔇  <b>/mute</b> & 🔊 <b>/unmute</b> › Toggles VIP notifications.\n⏹️  <b>/stop</b> › Stops the VIP tracker completely.\n"
+    if user.id in ADMIN_USERS: guide += "\n<b><u>🛡️ Admin Commands</u></b>\n👑  <b>/admin</b> › Opens the main admin panel.\n🤖  <b>/approvebot</b> <code>[code]</code> › Approves a new user bot.\n🚀  <b>/deploy</b> › Triggers a new deployment on Render.\n🕒  <b>/uptime</b> › Shows the bot's current running time.\n📢  <b>/broadcast</b> <code>[msg]</code> › Send a message to all users.\n✉️  <b>/msg</b> <code>[id] [msg]</code> › Sends a message to a user.\n✅  <b>/approve</b> <code>[id]</code> › Authorizes a new user.\n🎟️  <b>/access</b> <code>[ticket]</code> › Grants VIP using a ticket code.\n⏳  <b>/extendvip</b> <code>[id] [days]</code> › Extends a user's VIP.\n➕  <b>/addprized</b> <code>[item]</code> › Adds to prized list.\n➖  <b>/delprized</b> <code>[item]</code> › Removes from prized list.\n🚀  <b>/restart</b> › Restarts the bot process.\n🤖  <b>/bots</b> › Shows the status of every bot.\n⏯️  <b>/stopbot</b> & <b>/startbot</b> <code>[@username]</code> › Stops or starts a bot.\n"
     await update.message.reply_html(guide)
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
-    await log_user_activity(user, "/stats", context.bot)
+    log_user_activity(user, "/stats", context.bot)
     user_info = USER_INFO_CACHE.get(str(user.id), {})
     command_count = user_info.get('command_count', 0)
     approved_date_str = user_info.get('approved_date')
@@ -781,8 +2066,8 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         stats_message += f"<b>Member Since:</b> {approved_date.strftime('%B %d, %Y')} ({days_since} days ago)\n"
     
     status_line = "<b>Status:</b> ✅ Standard User"
-    if str(user.id) in VIP_USERS and datetime.fromisoformat(VIP_USERS.get(str(user.id), '1970-01-01T00:00:00+00:00')) > datetime.now(pytz.utc):
-        vip_exp_date = datetime.fromisoformat(VIP_USERS[str(user.id)])
+    if is_vip(user.id):
+        vip_exp_date = VIP_USERS.get(user.id)
         status_line = f"<b>Status:</b> ⭐ VIP (Expires: {vip_exp_date.strftime('%B %d, %Y')})"
     
     stats_message += status_line
@@ -796,42 +2081,29 @@ async def check_for_updates(context: ContextTypes.DEFAULT_TYPE):
             update_message = f"🚀 <b>A new version (v{BOT_VERSION}) is available!</b>\n\nAn admin can update your session to get the latest features."
             keyboard = [[InlineKeyboardButton("Update My Session", callback_data='self_update_session')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            for chat_id, tracker_data in list(ACTIVE_TRACKERS.items()):
-                if tracker_data.get('version') != BOT_VERSION:
-                    try: await application.bot.send_message(chat_id=chat_id, text=update_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-                    except Exception as e: logger.error(f"Failed to send update notice to {chat_id}: {e}")
-        version_filepath = get_data_filepath("version.txt")
-        with open(version_filepath, "w") as f: f.write(BOT_VERSION)
+            outdated = [chat_id for chat_id, tracker_data in ACTIVE_TRACKERS.items() if tracker_data.get('version') != BOT_VERSION]
+            await send_to_many(application.bot, outdated, update_message, "update notice", reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        save_setting('last_known_version', BOT_VERSION)
         LAST_KNOWN_VERSION = BOT_VERSION
 async def send_welcome_video(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     processing_msg = None
     try:
-        processing_msg = await context.bot.send_message(chat_id=chat_id, text="🎁 Preparing your welcome video...")
-        ydl_opts = {'format': 'best[ext=mp4][height<=720]/best[ext=mp4]/best','outtmpl': f'{chat_id}_welcome_video.%(ext)s','quiet': True}
-        loop = asyncio.get_running_loop()
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await loop.run_in_executor(None, lambda: ydl.extract_info(WELCOME_VIDEO_URL, download=True))
-            filename = ydl.prepare_filename(info).replace('.webm', '.mp4')
+        if not media_file_id('welcome_video', context.bot): processing_msg = await context.bot.send_message(chat_id=chat_id, text="🎁 Preparing your welcome video...")
         caption_text = "✨ <b>Welcome to the GAG Stock Alerter!</b> ✨\n\nThis video is a small token to welcome you to our community. I'm here to help you track all the latest items.\n\nType /help to see all available commands."
-        with open(filename, 'rb') as video_file:
-            await context.bot.send_video(chat_id=chat_id, video=video_file, caption=caption_text, parse_mode=ParseMode.HTML)
+        await send_cached_media(context.bot, chat_id, 'welcome_video', caption=caption_text, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error(f"Failed to send welcome video to {chat_id}: {e}")
         await context.bot.send_message(chat_id=chat_id, text="Sorry, I couldn't prepare your welcome video, but you have full access to the bot!")
     finally:
         if processing_msg: await processing_msg.delete()
-        if 'filename' in locals() and os.path.exists(filename): os.remove(filename)
 
 # --- REPLY & CALLBACK HANDLERS ---
 async def reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id in BANNED_USERS or user.id not in AUTHORIZED_USERS: return
     if update.message.reply_to_message and update.message.reply_to_message.text and "A message from the Bot Admin" in update.message.reply_to_message.text:
-        await log_user_activity(user, "[Reply to Admin]", context.bot)
+        log_user_activity(user, "[Reply to Admin]", context.bot)
         reply_text = f"🗣️ <b>New Reply from User:</b>\n\n<b>From:</b> {user.first_name} (<code>{user.id}</code>)\n<b>Message:</b> <i>{update.message.text}</i>\n\nTo reply, use <code>/msg {user.id} [your message]</code>"
-        for admin_id in ADMIN_USERS:
-            try: await context.application.bot.send_message(chat_id=admin_id, text=reply_text, parse_mode=ParseMode.HTML)
-            except Exception as e: logger.error(f"Failed to forward reply to admin {admin_id}: {e}")
+        await send_to_many(context.application.bot, ADMIN_USERS, reply_text, "reply forward", parse_mode=ParseMode.HTML)
         await update.message.reply_text("✅ Your reply has been sent to the admins.")
 async def self_update_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query; await query.answer()
@@ -841,7 +2113,7 @@ async def self_update_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.message.edit_text("Your session has already ended. Please use /start to begin a new one.")
         return
     await query.message.edit_text("⚙️ Updating your session... Please wait.")
-    tracker_info['task'].cancel()
+    stop_tracking(user.id)
     mock_chat = type('MockChat', (), {'id': user.id, 'type': 'private'})()
     mock_message = type('MockMessage', (), {'from_user': user, 'chat': mock_chat, 'reply_text': query.message.reply_text, 'reply_html': query.message.reply_html,'delete': query.message.delete, 'text': '/start'})()
     mock_update = type('MockUpdate', (), {'effective_user': user, 'message': mock_message, 'effective_chat': mock_chat, 'callback_query': query})
@@ -868,7 +2140,8 @@ async def update_and_redeploy_handler(update: Update, context: ContextTypes.DEFA
         await msg.edit_text("✅ Syntax OK. Preparing for redeployment...")
         
         flag_data = {'admin_id': user_id, 'timestamp': datetime.now(pytz.utc).isoformat()}
-        save_json_to_file('update_flag.json', flag_data)
+        save_setting('update_flag', flag_data)
+        prepare_for_exec()
         os.rename(temp_script_name, script_name)
 
         await msg.edit_text("🚀 Bot code updated. Restarting now...")
@@ -882,12 +2155,12 @@ async def update_and_redeploy_handler(update: Update, context: ContextTypes.DEFA
         await msg.edit_text(f"❌ An error occurred: {e}")
         if os.path.exists(temp_script_name): os.remove(temp_script_name)
 
-async def handle_post_update_notifications(app: Application):
-    update_flag_path = get_data_filepath('update_flag.json')
-    if not os.path.exists(update_flag_path): return
+async def handle_post_update_notifications(bot: Bot):
+    flag_data = STATE_STORE.get_setting('update_flag')
+    if not flag_data: return
 
     logger.info("Update flag found. Broadcasting notification to users.")
-    flag_data = load_json_from_file('update_flag.json'); admin_id = flag_data.get('admin_id')
+    admin_id = flag_data.get('admin_id')
 
     update_message = (
         f"🎉 <b>Bot Update Successful!</b> 🎉\n\n"
@@ -897,81 +2170,270 @@ async def handle_post_update_notifications(app: Application):
     keyboard = [[InlineKeyboardButton("🔄 Update My Session", callback_data='self_update_session')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    sent_count = 0
-    for user_id in AUTHORIZED_USERS:
-        if user_id in BANNED_USERS: continue
-        try:
-            await app.bot.send_message(chat_id=user_id, text=update_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-            sent_count += 1; await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.warning(f"Could not send update notification to user {user_id}: {e}")
+    sent_count = await send_to_many(bot, AUTHORIZED_USERS - BANNED_USERS, update_message, "update notification", reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
     if admin_id:
         try:
-            await app.bot.send_message(chat_id=admin_id, text=f"✅ Redeployment complete. Sent update notifications to {sent_count} users.")
+            await bot.send_message(chat_id=admin_id, text=f"✅ Redeployment complete. Sent update notifications to {sent_count} users.")
         except Exception: pass
-    os.remove(update_flag_path)
+    delete_row('settings', 'update_flag')
     logger.info("Update flag removed.")
 
+COMMAND_HANDLERS = { "start": start_cmd, "stop": stop_cmd, "refresh": refresh_cmd, "next": next_cmd, "registerbot": register_bot_cmd, "help": help_cmd, "mute": mute_cmd, "unmute": unmute_cmd, "recent": recent_cmd, "lastseen": lastseen_cmd, "frequency": frequency_cmd, "odds": odds_cmd, "listprized": listprized_cmd, "stats": stats_cmd, "requestvip": requestvip_cmd, "admin": admin_cmd, "approvebot": approve_bot_cmd, "uptime": uptime_cmd, "deploy": deploy_cmd, "approve": approve_cmd, "addadmin": add_admin_cmd, "msg": msg_cmd, "adminlist": adminlist_cmd, "addprized": addprized_cmd, "delprized": delprized_cmd, "restart": restart_cmd, "broadcast": broadcast_cmd, "extendvip": extendvip_cmd, "access": access_cmd, "addcommand": addcommand_cmd, "delcommand": delcommand_cmd, "listcommands": listcommands_cmd, "bots": bots_cmd, "stopbot": stopbot_cmd, "startbot": startbot_cmd }
+
 def register_handlers(app: Application):
-    all_handlers = { "start": start_cmd, "stop": stop_cmd, "refresh": refresh_cmd, "next": next_cmd, "registerbot": register_bot_cmd, "help": help_cmd, "mute": mute_cmd, "unmute": unmute_cmd, "recent": recent_cmd, "listprized": listprized_cmd, "stats": stats_cmd, "requestvip": requestvip_cmd, "admin": admin_cmd, "approvebot": approve_bot_cmd, "uptime": uptime_cmd, "deploy": deploy_cmd, "approve": approve_cmd, "addadmin": add_admin_cmd, "msg": msg_cmd, "adminlist": adminlist_cmd, "addprized": addprized_cmd, "delprized": delprized_cmd, "restart": restart_cmd, "broadcast": broadcast_cmd, "extendvip": extendvip_cmd, "access": access_cmd, "addcommand": addcommand_cmd, "delcommand": delcommand_cmd, "listcommands": listcommands_cmd }
-    for cmd_name, func in all_handlers.items(): app.add_handler(CommandHandler(cmd_name, func))
+    app.add_handler(TypeHandler(Update, access_gate), group=-1)
+    # Commands answer new messages only; edited ones would re-run them, and the handlers reply via update.message.
+    for cmd_name, func in COMMAND_HANDLERS.items(): app.add_handler(CommandHandler(cmd_name, func, filters=filters.UpdateType.MESSAGE))
     
     app.add_handler(CallbackQueryHandler(admin_callback_handler, pattern='^admin_'))
     app.add_handler(CallbackQueryHandler(self_update_callback, pattern='^self_update_session$'))
-    app.add_handler(MessageHandler(filters.REPLY, reply_handler))
+    app.add_handler(MessageHandler(filters.REPLY & ~filters.COMMAND, reply_handler))
     app.add_handler(MessageHandler(filters.Document.FileExtension("py") & filters.User(user_id=BOT_OWNER_ID), update_and_redeploy_handler))
+    # Registered after every built-in command, so it only sees commands none of them claimed.
+    app.add_handler(MessageHandler(filters.COMMAND, custom_command_router))
     
     if app.bot.token == TOKEN:
         app.job_queue.run_once(check_for_updates, 15, data=app)
 
-async def run_bot(app: Application):
-    """Initializes and runs a single bot instance, designed to be resilient."""
+# --- BOT SUPERVISOR ---
+# Each bot runs in its own task. A failure restarts only that bot, with exponential backoff; a token
+# Telegram rejects is quarantined until an admin starts it again. With BOT_SHARDS > 1, shard 0 also
+# runs the other shards as child processes of this same script and restarts them if they exit.
+def is_priority_update(update: object) -> bool:
+    query = update.callback_query if isinstance(update, Update) else None
+    return bool(query and query.data and query.data.startswith(('admin_', 'self_update')) and (query.from_user.id in ADMIN_USERS or query.from_user.id == BOT_OWNER_ID))
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, but in arrival order within each chat, with a separate lane for admin callbacks."""
+    def __init__(self, workers: int = UPDATE_WORKERS, priority_workers: int = UPDATE_PRIORITY_WORKERS):
+        # The base semaphore only bounds updates in flight; worker slots are taken after the chat's turn
+        # comes up, so a chat with a backlog queues behind itself without holding slots others need.
+        super().__init__(max(UPDATE_MAX_PENDING, workers + priority_workers))
+        self.lane, self.priority_lane = asyncio.Semaphore(workers), asyncio.Semaphore(priority_workers)
+        self.chats: dict[int, list] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        lane = self.priority_lane if is_priority_update(update) else self.lane
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with lane: await coroutine
+            return
+        # [lock, holders]: the entry is dropped only when no update for the chat is running or waiting.
+        entry = self.chats.get(chat.id)
+        if entry is None: entry = self.chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with lane: await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]: self.chats.pop(chat.id, None)
+
+    async def initialize(self) -> None: pass
+
+    async def shutdown(self) -> None: self.chats.clear()
+
+def build_bot_application(token: str) -> Application:
+    bot_app = Application.builder().token(token).concurrent_updates(ChatOrderedUpdateProcessor()).build()
+    register_handlers(bot_app)
+    return bot_app
+
+# Webhook paths use a hash of the token, so the token itself never appears in a URL or access log.
+WEBHOOK_ROUTES: dict[str, Application] = {}
+
+def webhook_route_id(token: str) -> str:
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+async def start_update_ingestion(bot_app: Application) -> str:
+    """Points the bot's webhook at the shared server, or falls back to long polling; returns the mode used."""
+    if USE_WEBHOOKS and BOT_SHARD_INDEX == 0:
+        route_id = webhook_route_id(bot_app.bot.token)
+        WEBHOOK_ROUTES[route_id] = bot_app
+        try:
+            await bot_app.bot.set_webhook(url=f"{WEBHOOK_BASE_URL.rstrip('/')}/telegram/{route_id}", secret_token=WEBHOOK_SECRET)
+            return 'webhook'
+        except InvalidToken: WEBHOOK_ROUTES.pop(route_id, None); raise
+        except Exception as e:
+            WEBHOOK_ROUTES.pop(route_id, None)
+            logger.warning(f"Could not set webhook for @{bot_app.bot.username}, falling back to polling: {e}")
+    await bot_app.updater.start_polling()
+    return 'polling'
+
+async def shutdown_bot_application(bot_app: Application, delete_webhook: bool = False):
+    WEBHOOK_ROUTES.pop(webhook_route_id(bot_app.bot.token), None)
     try:
-        await app.initialize()
-        logger.info(f"Starting bot polling for @{app.bot.username}...")
-        await app.run_polling()
-    except Exception as e:
-        # This will catch any error during initialization or polling
-        logger.critical(f"A bot has crashed, shutting down the process. Error: {e}")
-        # We re-raise the exception to ensure asyncio.gather knows a task has failed.
-        raise
+        # Without this Telegram keeps retrying a stopped bot's updates into 404s.
+        if delete_webhook: await bot_app.bot.delete_webhook()
+        if bot_app.updater and bot_app.updater.running: await bot_app.updater.stop()
+        if bot_app.running: await bot_app.stop()
+        await bot_app.shutdown()
+    except Exception as e: logger.warning(f"Error while shutting down bot ...{bot_app.bot.token[-4:]}: {e}")
+
+def shard_for(token: str) -> int:
+    if token == TOKEN: return 0
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), 'big') % BOT_SHARDS
+
+ATTACHED_TOKENS = set()
+
+async def attach_bot(bot: Bot):
+    """Points trackers and the outbound dispatcher at a (re)started bot; the first time, resumes its saved trackers."""
+    dispatcher = DISPATCHERS.get(bot.token)
+    if dispatcher is not None: dispatcher.bot = bot
+    for tracker_info in ACTIVE_TRACKERS.values():
+        if tracker_info['bot'].token == bot.token: tracker_info['bot'] = bot
+    if bot.token in ATTACHED_TOKENS: return
+    ATTACHED_TOKENS.add(bot.token)
+    restore_trackers(bot)
+    if bot.token == TOKEN: await handle_post_update_notifications(bot)
+
+class BotRunner:
+    def __init__(self, token: str):
+        self.token, self.app, self.task = token, None, None
+        self.state, self.failures, self.last_error, self.started_at, self.mode = 'starting', 0, None, None, None
+        # Set when the bot is going down for good (stopped or quarantined), not restarting or redeploying.
+        self.release_webhook = False
+
+class BotSupervisor:
+    def __init__(self):
+        self.runners: dict[str, BotRunner] = {}
+        self.workers: dict[int, asyncio.subprocess.Process] = {}
+        self.worker_tasks: list[asyncio.Task] = []
+
+    def owns(self, token: str) -> bool:
+        return shard_for(token) == BOT_SHARD_INDEX
+
+    def start(self, token: str) -> BotRunner:
+        runner = self.runners.get(token)
+        if runner is not None and runner.task is not None and not runner.task.done(): return runner
+        runner = self.runners[token] = BotRunner(token)
+        runner.task = asyncio.create_task(self._run(runner))
+        return runner
+
+    async def stop(self, token: str, release_webhook: bool = True) -> bool:
+        runner = self.runners.get(token)
+        if runner is None or runner.task is None or runner.task.done(): return False
+        runner.release_webhook = release_webhook; runner.task.cancel()
+        try: await runner.task
+        except asyncio.CancelledError: pass
+        runner.state = 'stopped'
+        return True
+
+    async def stop_all(self):
+        for task in self.worker_tasks: task.cancel()
+        await asyncio.gather(*self.worker_tasks, *(self.stop(token, release_webhook=False) for token in list(self.runners)), return_exceptions=True)
+
+    def reconcile(self):
+        """Starts the bots this shard owns that were never started here; manually stopped bots stay stopped."""
+        for token in [TOKEN, *CHILD_BOTS]:
+            if self.owns(token) and token not in self.runners: self.start(token)
+
+    async def _run(self, runner: BotRunner):
+        while True:
+            bot_app = runner.app = build_bot_application(runner.token)
+            started = time.monotonic()
+            try:
+                runner.state = 'starting'
+                await bot_app.initialize(); await bot_app.start()
+                runner.mode = await start_update_ingestion(bot_app)
+                runner.state, runner.started_at, runner.last_error = 'running', datetime.now(pytz.utc), None
+                logger.info(f"Bot @{bot_app.bot.username} is running ({runner.mode}).")
+                await attach_bot(bot_app.bot)
+                # Polling retries network errors on its own; this catches a token revoked while running.
+                while True:
+                    await asyncio.sleep(BOT_HEALTH_CHECK_SECONDS)
+                    await bot_app.bot.get_me()
+                    if time.monotonic() - started >= BOT_STABLE_SECONDS: runner.failures = 0
+            except InvalidToken as e:
+                runner.state, runner.last_error, runner.release_webhook = 'quarantined', str(e), True
+                logger.error(f"Bot ...{runner.token[-4:]} was rejected by Telegram and is quarantined: {e}")
+                return
+            except Exception as e:
+                if time.monotonic() - started >= BOT_STABLE_SECONDS: runner.failures = 0
+                runner.failures += 1; runner.last_error = str(e)
+                logger.error(f"Bot ...{runner.token[-4:]} failed ({runner.failures} in a row): {e}")
+            finally:
+                await shutdown_bot_application(bot_app, delete_webhook=runner.release_webhook and runner.mode == 'webhook')
+            runner.state = 'backoff'
+            await asyncio.sleep(min(BOT_RESTART_BASE_SECONDS * 2 ** (runner.failures - 1), BOT_RESTART_MAX_SECONDS))
+
+    def start_workers(self):
+        self.worker_tasks = [asyncio.create_task(self._run_worker(index)) for index in range(1, BOT_SHARDS)]
+
+    async def _run_worker(self, index: int):
+        failures = 0
+        while True:
+            started = time.monotonic()
+            proc = self.workers[index] = await asyncio.create_subprocess_exec(sys.executable, *sys.argv, env={**os.environ, 'BOT_SHARD_INDEX': str(index)})
+            logger.info(f"Started shard worker {index} (pid {proc.pid}).")
+            try: code = await proc.wait()
+            except asyncio.CancelledError:
+                if proc.returncode is None: proc.terminate(); await proc.wait()
+                raise
+            failures = 0 if time.monotonic() - started >= BOT_STABLE_SECONDS else failures + 1
+            delay = min(BOT_RESTART_BASE_SECONDS * 2 ** failures, BOT_RESTART_MAX_SECONDS)
+            logger.error(f"Shard worker {index} exited with code {code}; restarting in {delay:.0f}s.")
+            await asyncio.sleep(delay)
+
+    def terminate_workers(self):
+        for proc in self.workers.values():
+            if proc.returncode is None: proc.terminate()
+
+SUPERVISOR = BotSupervisor()
+
+async def shard_refresh_loop():
+    """Keeps this process's in-memory state in step with the other shards through the shared store."""
+    while True:
+        await asyncio.sleep(SHARD_REFRESH_SECONDS)
+        try: flush_pending_writes(); load_all_data(log=False); SUPERVISOR.reconcile()
+        except Exception as e: logger.error(f"Failed to refresh shard state: {e}")
 
 async def main_async():
     if not TOKEN or not BOT_OWNER_ID: 
         logger.critical("Main bot TOKEN and BOT_OWNER_ID are not set!"); 
         return
     load_all_data()
-    
-    Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': int(os.environ.get('PORT', 8080))}, daemon=True).start()
+    main_task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
 
-    main_app = Application.builder().token(TOKEN).build()
-    register_handlers(main_app)
-    await handle_post_update_notifications(main_app)
+    def on_web_exit(task: asyncio.Task):
+        # The dashboard and webhooks share this server, so losing it (e.g. the port is taken) stops the process.
+        if not task.cancelled() and task.exception(): logger.critical(f"Web server stopped: {task.exception()}"); main_task.cancel()
 
-    bot_tasks = [run_bot(main_app)]
-    child_tokens = set(CHILD_BOTS.keys()) - {TOKEN}
+    web_task = None
+    if BOT_SHARD_INDEX == 0:
+        # A never-set shutdown trigger keeps Hypercorn from installing its own SIGINT/SIGTERM handlers.
+        web_task = asyncio.create_task(app.run_task(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), shutdown_trigger=asyncio.Event().wait))
+        web_task.add_done_callback(on_web_exit)
+        if BOT_SHARDS > 1: SUPERVISOR.start_workers()
+    ensure_persistence()
+    ensure_profile_refresher()
+    ensure_vip_expiry()
+    ensure_restock_stats()
+    ensure_stock_feed(load_restore_baseline())
+    refresh_task = asyncio.create_task(shard_refresh_loop()) if BOT_SHARDS > 1 else None
 
-    for token in child_tokens:
-        try:
-            child_app = Application.builder().token(token).build()
-            register_handlers(child_app)
-            bot_tasks.append(run_bot(child_app))
-        except Exception as e:
-            logger.error(f"Failed to prepare child bot with token ending in ...{token[-4:]}. Error: {e}")
+    SUPERVISOR.reconcile()
+    logger.info(f"Bot Factory [v{BOT_VERSION}] shard {BOT_SHARD_INDEX}/{BOT_SHARDS} is starting {len(SUPERVISOR.runners)} bot(s)...")
 
-    logger.info(f"Bot Factory [v{BOT_VERSION}] is starting {len(bot_tasks)} bot(s)...")
-    
     try:
-        await asyncio.gather(*bot_tasks)
-    except Exception as e:
-        logger.critical(f"A critical error in a bot task caused the main process to stop. Error: {e}")
-
+        await asyncio.Future()  # Runs until cancelled by Ctrl+C or SIGTERM.
+    finally:
+        logger.info(f"Shard {BOT_SHARD_INDEX} is shutting down...")
+        if refresh_task: refresh_task.cancel()
+        await SUPERVISOR.stop_all()
+        if web_task: web_task.cancel(); await asyncio.gather(web_task, return_exceptions=True)
+        flush_pending_writes()
+        STATE_STORE.close(); STOCK_HISTORY.close()
+        await close_http_client()
+        shutdown_media_pool()
+        logger.info("Shutdown complete.")
+        if web_task and not web_task.cancelled() and web_task.exception(): sys.exit(1)
 
 if __name__ == '__main__':
     try:
         asyncio.run(main_async())
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Bot shutting down by request...")
     except Exception as e:
         logger.critical(f"Main execution block failed: {e}")